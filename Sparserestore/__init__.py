@@ -1,32 +1,54 @@
-from tempfile import TemporaryDirectory
-from pathlib import Path
-
 from pymobiledevice3.lockdown import create_using_usbmux
 from pymobiledevice3.services.mobilebackup2 import Mobilebackup2Service
 from pymobiledevice3.exceptions import PyMobileDevice3Exception
 from pymobiledevice3.services.diagnostics import DiagnosticsService
 from pymobiledevice3.lockdown import LockdownClient
 
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Awaitable, Callable, Iterable, Optional
+
 from . import backup
+from .staging import stage_backup, StagingStats
+from .cache import StagedBackupCache
 
-def reboot_device(reboot: bool = False, lockdown_client: LockdownClient = None):
+async def reboot_device(reboot: bool = False, lockdown_client: LockdownClient = None):
     if reboot and lockdown_client != None:
         print("Success! Rebooting your device...")
-        with DiagnosticsService(lockdown_client) as diagnostics_service:
-            diagnostics_service.restart()
+        async with DiagnosticsService(lockdown_client) as diagnostics_service:
+            await diagnostics_service.restart()
         print("Remember to turn Find My back on!")
 
-def perform_restore(backup: backup.Backup, reboot: bool = False, lockdown_client: LockdownClient = None):
+@contextmanager
+def _staged_source(backup: backup.Backup, staging: str, staging_workers: int, cache: StagedBackupCache):
+    # yields the StagingStats and what the device restores from, the staged directory or a VirtualBackup
+    if staging == "virtual" and cache is None:
+        # imported here so the device link internals are only needed for this mode
+        from .virtual import VirtualBackup
+        virtual = VirtualBackup(backup)
+        # built up front so concurrent restores share one manifest
+        virtual.manifest()
+        yield StagingStats(backend="virtual", directory=None, seconds=0.0, bytes_written=0), virtual
+        return
+    with stage_backup(backup, staging, staging_workers, cache) as stats:
+        print(f"Staged {stats.bytes_written} bytes on {stats.backend} in {stats.seconds:.3f}s")
+        yield stats, str(stats.directory)
+
+async def _restore_source(source, reboot: bool = False, lockdown_client: LockdownClient = None):
     try:
-        with TemporaryDirectory() as backup_dir:
-            backup.write_to_directory(Path(backup_dir))
-            
-            if lockdown_client == None:
-                lockdown_client = create_using_usbmux()
-            with Mobilebackup2Service(lockdown_client) as mb:
-                mb.restore(backup_dir, system=True, reboot=False, copy=False, source=".")
-            # reboot the device
-            reboot_device(reboot, lockdown_client)
+        if lockdown_client == None:
+            lockdown_client = await create_using_usbmux()
+        if isinstance(source, str):
+            async with Mobilebackup2Service(lockdown_client) as mb:
+                await mb.restore(source, system=True, reboot=False, copy=False, source=".")
+        else:
+            from .virtual import VirtualMobilebackup2Service
+            async with VirtualMobilebackup2Service(lockdown_client) as mb:
+                await mb.restore_virtual(source, system=True, reboot=False, copy=False, source=".")
+        # reboot the device
+        await reboot_device(reboot, lockdown_client)
     except PyMobileDevice3Exception as e:
         if "Find My" in str(e):
             print("Find My must be disabled in order to use this tool.")
@@ -35,4 +57,74 @@ def perform_restore(backup: backup.Backup, reboot: bool = False, lockdown_client
         elif "crash_on_purpose" not in str(e):
             raise e
         else:
-            reboot_device(reboot, lockdown_client)
\ No newline at end of file
+            await reboot_device(reboot, lockdown_client)
+
+# staging is "disk" (the default temp directory), "ram" (tmpfs when available) or "virtual" (nothing is staged,
+# the device is served straight from the Backup), or pass a StagedBackupCache to reuse directories staged for
+# earlier restores; returns the StagingStats
+async def perform_restore(backup: backup.Backup, reboot: bool = False, lockdown_client: LockdownClient = None, staging_workers: int = None, staging: str = "disk", cache: StagedBackupCache = None) -> StagingStats:
+    with _staged_source(backup, staging, staging_workers, cache) as (stats, source):
+        await _restore_source(source, reboot, lockdown_client)
+    return stats
+
+@dataclass
+class DeviceRestoreResult:
+    serial: str
+    seconds: float
+    error: Optional[Exception] = None
+    # seconds from the end of the restore until the device was usable again, when that was waited for
+    ready_seconds: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+async def _restore_pooled(source, serial: str, reboot: bool, pool):
+    # the restore and the reboot share the device's session on the pool's loop
+    await _restore_source(source, reboot, await pool.get(serial))
+    if reboot:
+        # the device is rebooting, its next session has to be a new one
+        pool.invalidate(serial)
+
+# restores one staged backup to every device in serials, at most concurrency of them at a time;
+# a device that fails only gets its error recorded in its result, the others carry on
+# every restore runs on the loop of pool (a LockdownPool, the app's shared one by default) with the session
+# the pool keeps for its device
+# with reboot and wait_ready (a coroutine function called with a serial, returns once the device is usable again
+# and how long that took) a restore only counts as done once its device is back; the wait does not hold up the
+# next device's upload
+def perform_restore_many(backup: backup.Backup, serials: Iterable[str], reboot: bool = False, concurrency: int = 4, staging_workers: int = None, staging: str = "disk", cache: StagedBackupCache = None, wait_ready: Callable[[str], Awaitable[float]] = None, pool=None) -> dict[str, DeviceRestoreResult]:
+    serials = list(dict.fromkeys(serials))
+    if pool is None:
+        from devicemanagement.lockdown_pool import lockdown_pool as pool
+
+    def restore_device(serial: str) -> DeviceRestoreResult:
+        start = perf_counter()
+        try:
+            pool.run(_restore_pooled(source, serial, reboot, pool))
+        except Exception as e:
+            print(f"Restore to {serial} failed: {e}")
+            return DeviceRestoreResult(serial=serial, seconds=perf_counter() - start, error=e)
+        return DeviceRestoreResult(serial=serial, seconds=perf_counter() - start)
+
+    def wait_device(result: DeviceRestoreResult) -> DeviceRestoreResult:
+        try:
+            result.ready_seconds = pool.run(wait_ready(result.serial))
+        except Exception as e:
+            print(f"{result.serial} did not come back after rebooting: {e}")
+            result.error = e
+        return result
+
+    def restore_and_wait(serial: str):
+        result = restore_device(serial)
+        if wait_ready is None or not reboot or not result.ok:
+            return result
+        # the upload slot is free again while the device reboots
+        return waiters.submit(wait_device, result)
+
+    with _staged_source(backup, staging, staging_workers, cache) as (stats, source):
+        with ThreadPoolExecutor(max_workers=max(1, len(serials))) as waiters:
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(serials) or 1))) as uploads:
+                outcomes = list(uploads.map(restore_and_wait, serials))
+            results = [outcome.result() if isinstance(outcome, Future) else outcome for outcome in outcomes]
+    return {result.serial: result for result in results}
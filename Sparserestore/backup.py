@@ -1,23 +1,53 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+import os
 import plistlib
+import shutil
+import threading
 from pathlib import Path
 from base64 import b64decode
-from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1, sha256
+from tempfile import TemporaryFile
 from . import mbdb
 from .mbdb import _FileMode
 from random import randbytes
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
 # RWX:RX:RX
 DEFAULT = _FileMode.S_IRUSR | _FileMode.S_IWUSR | _FileMode.S_IXUSR | _FileMode.S_IRGRP | _FileMode.S_IXGRP | _FileMode.S_IROTH | _FileMode.S_IXOTH
 
+# payloads that are not in memory get hashed and copied this much at a time
+CHUNK_SIZE = 1 << 20
+
+# used for every record of a deterministic backup (2001-01-01, Apple's reference date)
+DETERMINISTIC_TIMESTAMP = 978307200
+
+def _timestamp(timestamp: Optional[int]) -> int:
+    return int(datetime.now().timestamp()) if timestamp is None else timestamp
+
+def _copy_file(source: Path, target: Path):
+    # let the kernel move the bytes (reflink/in-kernel copy where supported, sendfile/fcopyfile otherwise)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (AttributeError, OSError):
+            # not on Linux, or not supported between these filesystems
+            pass
+    shutil.copyfile(source, target)
+
 @dataclass
 class BackupFile:
     path: str
     domain: str
 
-    def to_record(self) -> mbdb.MbdbRecord:
+    def to_record(self, timestamp: Optional[int] = None) -> mbdb.MbdbRecord:
         raise NotImplementedError()
 
 @dataclass
@@ -28,14 +58,28 @@ class ConcreteFile(BackupFile):
     inode: Optional[int] = None
     mode: _FileMode = DEFAULT
 
-    def to_record(self) -> mbdb.MbdbRecord:
+    def chunks(self) -> Iterator[bytes]:
+        yield self.contents
+
+    def content_size(self) -> int:
+        return len(self.contents)
+
+    def content_digest(self) -> bytes:
+        return sha1(self.contents).digest()
+
+    def stage(self, target: Path, link: bool = True):
+        with open(target, "wb") as f:
+            f.write(self.contents)
+
+    def to_record(self, digest: Optional[bytes] = None, timestamp: Optional[int] = None) -> mbdb.MbdbRecord:
+        timestamp = _timestamp(timestamp)
         if self.inode is None:
             self.inode = int.from_bytes(randbytes(8), "big")
         return mbdb.MbdbRecord(
             domain=self.domain,
             filename=self.path,
             link="",
-            hash=sha1(self.contents).digest(),
+            hash=digest if digest is not None else self.content_digest(),
             key=b"",
             mode=self.mode | _FileMode.S_IFREG,
             #unknown2=0,
@@ -43,21 +87,107 @@ class ConcreteFile(BackupFile):
             inode=self.inode,
             user_id=self.owner,
             group_id=self.group,
-            mtime=int(datetime.now().timestamp()),
-            atime=int(datetime.now().timestamp()),
-            ctime=int(datetime.now().timestamp()),
-            size=len(self.contents),
+            mtime=timestamp,
+            atime=timestamp,
+            ctime=timestamp,
+            size=self.content_size(),
             flags=4,
             properties=[]
         )
 
+@dataclass
+class PathConcreteFile(ConcreteFile):
+    # payload stays on disk at contents, it is hashed in chunks and staged by linking or copying in the kernel;
+    # a link shares later edits of the source, so directories that outlive the restore have to be staged with link=False
+    contents: Path
+
+    def chunks(self) -> Iterator[bytes]:
+        with open(self.contents, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+    def content_size(self) -> int:
+        return os.stat(self.contents).st_size
+
+    def content_digest(self) -> bytes:
+        digest = sha1()
+        for chunk in self.chunks():
+            digest.update(chunk)
+        return digest.digest()
+
+    def stage(self, target: Path, link: bool = True):
+        if link:
+            try:
+                os.link(self.contents, target)
+                return
+            except OSError:
+                # different filesystem, or links are not supported there
+                pass
+        _copy_file(self.contents, target)
+
+@dataclass
+class StreamConcreteFile(ConcreteFile):
+    # payload comes from an iterable of byte chunks
+    # a one-shot iterator is spooled to an anonymous temporary file the first time it is read; restores to
+    # several devices read it at the same time, so every reader keeps its own position and seeks under the lock
+    contents: Iterable[bytes]
+    _spool: Optional[object] = field(default=None, init=False, repr=False, compare=False)
+    _spool_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def chunks(self) -> Iterator[bytes]:
+        with self._spool_lock:
+            if self._spool is None and iter(self.contents) is not self.contents:
+                spool = None
+            else:
+                if self._spool is None:
+                    self._spool = TemporaryFile()
+                    for chunk in self.contents:
+                        self._spool.write(chunk)
+                spool = self._spool
+        if spool is None:
+            yield from self.contents
+            return
+        position = 0
+        while True:
+            with self._spool_lock:
+                spool.seek(position)
+                chunk = spool.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+    def content_size(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks())
+
+    def content_digest(self) -> bytes:
+        digest = sha1()
+        for chunk in self.chunks():
+            digest.update(chunk)
+        return digest.digest()
+
+    def stage(self, target: Path, link: bool = True):
+        with open(target, "wb") as f:
+            for chunk in self.chunks():
+                f.write(chunk)
+
+def concrete_file(path: str, domain: str, contents, **kwargs) -> ConcreteFile:
+    # picks the ConcreteFile variant that matches how the payload is given
+    if isinstance(contents, (bytes, bytearray, memoryview)):
+        return ConcreteFile(path, domain, contents=bytes(contents), **kwargs)
+    # a str is a path on disk too, iterating it as a stream would send its characters
+    if isinstance(contents, (str, os.PathLike)):
+        return PathConcreteFile(path, domain, contents=Path(contents), **kwargs)
+    return StreamConcreteFile(path, domain, contents=contents, **kwargs)
+
 @dataclass
 class Directory(BackupFile):
     owner: int = 0
     group: int = 0
     mode: _FileMode = DEFAULT
 
-    def to_record(self) -> mbdb.MbdbRecord:
+    def to_record(self, timestamp: Optional[int] = None) -> mbdb.MbdbRecord:
+        timestamp = _timestamp(timestamp)
         return mbdb.MbdbRecord(
             domain=self.domain,
             filename=self.path,
@@ -70,9 +200,9 @@ class Directory(BackupFile):
             inode=0, # inode is not respected for directories
             user_id=self.owner,
             group_id=self.group,
-            mtime=int(datetime.now().timestamp()),
-            atime=int(datetime.now().timestamp()),
-            ctime=int(datetime.now().timestamp()),
+            mtime=timestamp,
+            atime=timestamp,
+            ctime=timestamp,
             size=0,
             flags=4,
             properties=[]
@@ -86,7 +216,8 @@ class SymbolicLink(BackupFile):
     inode: Optional[int] = None
     mode: _FileMode = DEFAULT
 
-    def to_record(self) -> mbdb.MbdbRecord:
+    def to_record(self, timestamp: Optional[int] = None) -> mbdb.MbdbRecord:
+        timestamp = _timestamp(timestamp)
         if self.inode is None:
             self.inode = int.from_bytes(randbytes(8), "big")
         return mbdb.MbdbRecord(
@@ -101,9 +232,9 @@ class SymbolicLink(BackupFile):
             inode=self.inode,
             user_id=self.owner,
             group_id=self.group,
-            mtime=int(datetime.now().timestamp()),
-            atime=int(datetime.now().timestamp()),
-            ctime=int(datetime.now().timestamp()),
+            mtime=timestamp,
+            atime=timestamp,
+            ctime=timestamp,
             size=0,
             flags=4,
             properties=[]
@@ -112,16 +243,89 @@ class SymbolicLink(BackupFile):
 @dataclass
 class Backup:
     files: list[BackupFile]
+    # fixed timestamps and inodes derived from path and contents, so the same files always stage to the same bytes
+    deterministic: bool = False
 
-    def write_to_directory(self, directory: Path):
-        for file in self.files:
-            if isinstance(file, ConcreteFile):
-                #print("Writing", file.path, "to", directory / sha1((file.domain + "-" + file.path).encode()).digest().hex())
-                with open(directory / sha1((file.domain + "-" + file.path).encode()).digest().hex(), "wb") as f:
-                    f.write(file.contents)
+    # file ids and content digests are memoized per file object for as long as the backup lives,
+    # payloads are expected not to change once they are part of it
+    _file_ids: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+    _digests: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+    # (directory, digest) -> payload already staged with those contents
+    _staged: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def file_id(self, file: BackupFile) -> str:
+        file_id = self._file_ids.get(id(file))
+        if file_id is None:
+            file_id = self._file_ids[id(file)] = mbdb.file_id(file.domain, file.path)
+        return file_id
+
+    def digest(self, file: ConcreteFile) -> bytes:
+        digest = self._digests.get(id(file))
+        if digest is None:
+            digest = self._digests[id(file)] = file.content_digest()
+        return digest
+
+    def _forget(self, file: BackupFile):
+        self._file_ids.pop(id(file), None)
+        self._digests.pop(id(file), None)
+
+    @staticmethod
+    def _run(workers: Optional[int], func, items: list):
+        # hashlib and file IO release the GIL, so these go to a thread pool unless asked to stay serial
+        if workers is not None and workers <= 1:
+            return list(map(func, items))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, items))
+
+    def _stage_payloads(self, directory: Path, files: list[BackupFile], workers: Optional[int] = None, link: bool = True):
+        # staging is content addressed: each distinct payload is written once and every other file id is a hardlink to it
+        # link=False copies payloads that are files on disk instead of linking them into the directory
+        concrete = [file for file in files if isinstance(file, ConcreteFile)]
+        self._run(workers, self.digest, concrete)
+
+        # when two files share a file id the later one wins, the same as writing them in order
+        targets = {self.file_id(file): file for file in concrete}
+        unique = {}
+        links = []
+        for file_id, file in targets.items():
+            digest = self.digest(file)
+            source = self._staged.get((directory, digest))
+            # an earlier payload can only be reused if this round does not overwrite it with something else
+            if source is not None and source.name in targets and self.digest(targets[source.name]) != digest:
+                source = None
+            if source is not None and source.name != file_id and source.exists():
+                links.append((source, directory / file_id))
+            elif digest in unique:
+                links.append((directory / self.file_id(unique[digest]), directory / file_id))
+            else:
+                unique[digest] = file
+
+        def stage(file: ConcreteFile):
+            #print("Writing", file.path, "to", directory / self.file_id(file))
+            target = directory / self.file_id(file)
+            target.unlink(missing_ok=True)
+            file.stage(target, link)
+        self._run(workers, stage, list(unique.values()))
+        # forget payloads that were overwritten with other contents, then remember the new ones
+        self._staged = {
+            (staged_directory, digest): source for (staged_directory, digest), source in self._staged.items()
+            if staged_directory != directory or source.name not in targets or self.digest(targets[source.name]) == digest
+        }
+        for digest, file in unique.items():
+            self._staged[(directory, digest)] = directory / self.file_id(file)
+
+        for source, target in links:
+            target.unlink(missing_ok=True)
+            try:
+                os.link(source, target)
+            except OSError:
+                _copy_file(source, target)
+
+    def write_to_directory(self, directory: Path, workers: Optional[int] = None, link: bool = True):
+        self._stage_payloads(directory, self.files, workers, link)
             
         with open(directory / "Manifest.mbdb", "wb") as f:
-            f.write(self.generate_manifest_db().to_bytes())
+            self.generate_manifest_db().write_to(f)
 
         with open(directory / "Status.plist", "wb") as f:
             f.write(self.generate_status())
@@ -133,11 +337,77 @@ class Backup:
             f.write(plistlib.dumps({}))
         
 
-    def generate_manifest_db(self): # Manifest.mbdb
-        records = []
+    def append_to_directory(self, directory: Path, files: list[BackupFile], workers: Optional[int] = None):
+        # adds files to a directory staged by write_to_directory, only the new records get written to Manifest.mbdb;
+        # a path that is already in the manifest is replaced: its old record is tombstoned and the manifest
+        # compacted, so every path keeps exactly one record
+        # when files names a path twice the later one wins, the same as writing them in order
+        files = list({(file.domain, file.path): file for file in files}.values())
+        paths = {(file.domain, file.path) for file in files}
+        self._stage_payloads(directory, files, workers)
+        with mbdb.Mbdb.open(directory / "Manifest.mbdb", "a") as manifest:
+            replaced = sum(manifest.tombstone(domain, path) for domain, path in paths)
+            manifest.extend(self._records(files))
+            if replaced:
+                manifest.compact()
+        appended = {id(file) for file in files}
+        for file in self.files:
+            if (file.domain, file.path) in paths and id(file) not in appended:
+                self._forget(file)
+        self.files = [file for file in self.files if (file.domain, file.path) not in paths] + files
+
+    def remove_from_directory(self, directory: Path, files: list[BackupFile]):
+        # drops files from a staged directory, their records are tombstoned and the manifest compacted once at the end
+        with mbdb.Mbdb.open(directory / "Manifest.mbdb", "a") as manifest:
+            for file in files:
+                manifest.tombstone(file.domain, file.path)
+                if isinstance(file, ConcreteFile):
+                    (directory / self.file_id(file)).unlink(missing_ok=True)
+                self._forget(file)
+            manifest.compact()
+        self.files = [file for file in self.files if file not in files]
+
+    def _derived_inode(self, file: BackupFile) -> int:
+        if isinstance(file, ConcreteFile):
+            contents = self.digest(file)
+        else:
+            contents = getattr(file, "target", "").encode("utf-8")
+        return int.from_bytes(sha1(self.file_id(file).encode() + b"\x00" + contents).digest()[:8], "big")
+
+    def _records(self, files: list[BackupFile]):
+        # every record of one manifest gets the same timestamp
+        timestamp = DETERMINISTIC_TIMESTAMP if self.deterministic else int(datetime.now().timestamp())
+        for file in files:
+            if self.deterministic and getattr(file, "inode", 0) is None:
+                file.inode = self._derived_inode(file)
+            if isinstance(file, ConcreteFile):
+                yield file.to_record(self.digest(file), timestamp=timestamp)
+            else:
+                yield file.to_record(timestamp=timestamp)
+
+    def plan_digest(self) -> str:
+        # identifies what this backup stages to, used as the key of StagedBackupCache
+        plan = sha256(b"backup-plan-1")
+        plan.update(b"deterministic" if self.deterministic else b"")
         for file in self.files:
-            records.append(file.to_record())
-        return mbdb.Mbdb(records=records)
+            fields = [type(file).__name__, file.domain, file.path]
+            for name in ("owner", "group", "mode", "inode", "target"):
+                if hasattr(file, name):
+                    value = getattr(file, name)
+                    # a derived inode follows from the path and contents, which are already part of the plan
+                    if name == "inode" and self.deterministic and value == self._derived_inode(file):
+                        value = None
+                    fields.append(f"{name}={value!r}")
+            if isinstance(file, ConcreteFile):
+                fields.append(self.digest(file).hex())
+            for item in fields:
+                item = item.encode("utf-8")
+                plan.update(len(item).to_bytes(4, "big"))
+                plan.update(item)
+        return plan.hexdigest()
+
+    def generate_manifest_db(self): # Manifest.mbdb
+        return mbdb.Mbdb(records=list(self._records(self.files)))
     
     def generate_status(self) -> bytes: # Status.plist
         return plistlib.dumps({
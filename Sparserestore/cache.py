@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Optional
+import os
+import shutil
+import sys
+import threading
+
+from . import backup as backup_module
+from .staging import StagingStats, _directory_size
+
+# written last into a cached directory, holds its size; its mtime is the last time the entry was used
+_COMPLETE = ".complete"
+
+def default_cache_root() -> Path:
+    if sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    elif sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    return base / "QuietDaemon" / "staged"
+
+class StagedBackupCache:
+    # fully staged backup directories keyed by Backup.plan_digest(), the least recently used ones are
+    # evicted once the cache grows past max_bytes; only deterministic backups can be cached
+    def __init__(self, root: Optional[Path] = None, max_bytes: int = 2 << 30):
+        self.root = Path(root) if root is not None else default_cache_root()
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # entries that are being restored right now are never evicted
+        self._pinned = {}
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key
+
+    def _complete(self, entry: Path) -> bool:
+        return (entry / _COMPLETE).exists()
+
+    def _build(self, backup: backup_module.Backup, key: str, workers: Optional[int]) -> int:
+        # stage next to the cache and rename into place, so a half written entry is never visible
+        entry = self._entry(key)
+        if entry.exists() and not self._complete(entry):
+            # left over from an interrupted eviction
+            shutil.rmtree(entry, ignore_errors=True)
+        staging = Path(mkdtemp(prefix=".staging-", dir=self.root))
+        try:
+            # payloads are copied, a hardlink would let an edit of the source change the entry under its key
+            backup.write_to_directory(staging, workers=workers, link=False)
+            size = _directory_size(staging)
+            (staging / _COMPLETE).write_text(str(size))
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # someone else finished the same entry first
+                if not self._complete(entry):
+                    raise
+        finally:
+            if staging.exists():
+                shutil.rmtree(staging, ignore_errors=True)
+        return size
+
+    @contextmanager
+    def staged(self, backup: backup_module.Backup, workers: Optional[int] = None):
+        # yields StagingStats for the cached directory of this backup, staging it first on a miss
+        if not backup.deterministic:
+            raise ValueError("Only deterministic backups can be cached")
+        start = perf_counter()
+        key = backup.plan_digest()
+        entry = self._entry(key)
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            if self._complete(entry):
+                os.utime(entry / _COMPLETE)
+                stats = StagingStats(backend="cache", directory=entry, seconds=perf_counter() - start, bytes_written=0)
+            else:
+                size = self._build(backup, key, workers)
+                stats = StagingStats(backend="disk", directory=entry, seconds=perf_counter() - start, bytes_written=size)
+                self.evict()
+            yield stats
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if self._pinned[key] == 0:
+                    del self._pinned[key]
+
+    def entries(self) -> list[tuple[Path, int, float]]:
+        # (directory, size, last used) of every complete entry, oldest first
+        entries = []
+        for entry in self.root.iterdir():
+            marker = entry / _COMPLETE
+            try:
+                entries.append((entry, int(marker.read_text()), marker.stat().st_mtime))
+            except (OSError, ValueError):
+                continue
+        entries.sort(key=lambda item: item[2])
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            with self._lock:
+                if entry.name in self._pinned:
+                    continue
+                # drop the marker first so nobody picks up an entry that is half deleted
+                (entry / _COMPLETE).unlink(missing_ok=True)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for entry, _, _ in self.entries():
+            if entry.name not in self._pinned:
+                (entry / _COMPLETE).unlink(missing_ok=True)
+                shutil.rmtree(entry, ignore_errors=True)
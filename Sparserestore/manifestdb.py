@@ -0,0 +1,214 @@
+from pathlib import Path
+from typing import Optional
+import plistlib
+import sqlite3
+
+from .mbdb import Mbdb, MbdbRecord, _FileMode, file_id
+
+# Manifest.db layout used by iOS 10+ backups, the domain/path index is an addition for prefix queries
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, file BLOB);
+CREATE INDEX IF NOT EXISTS FilesDomainIdx ON Files(domain);
+CREATE INDEX IF NOT EXISTS FilesRelativePathIdx ON Files(relativePath);
+CREATE INDEX IF NOT EXISTS FilesDomainRelativePathIdx ON Files(domain, relativePath);
+CREATE TABLE IF NOT EXISTS Properties (key TEXT PRIMARY KEY, value BLOB);
+"""
+
+# values of the flags column
+_FLAG_FILE = 1
+_FLAG_DIRECTORY = 2
+_FLAG_SYMLINK = 4
+
+def _flags_for(mode: int) -> int:
+    file_type = mode & _FileMode.S_IFMT
+    if file_type == _FileMode.S_IFDIR:
+        return _FLAG_DIRECTORY
+    if file_type == _FileMode.S_IFLNK:
+        return _FLAG_SYMLINK
+    return _FLAG_FILE
+
+def _archive_record(record: MbdbRecord) -> bytes:
+    # the file column holds an NSKeyedArchiver plist of an MBFile
+    objects = ["$null"]
+
+    def ref(value) -> plistlib.UID:
+        objects.append(value)
+        return plistlib.UID(len(objects) - 1)
+
+    mbfile = {
+        "Birth": record.ctime,
+        "Flags": record.flags,
+        "GroupID": record.group_id,
+        "InodeNumber": record.inode,
+        "LastModified": record.mtime,
+        "LastStatusChange": record.ctime,
+        "Mode": int(record.mode),
+        "ProtectionClass": 0,
+        "Size": record.size,
+        "UserID": record.user_id,
+    }
+    objects.append(mbfile)
+    mbfile["RelativePath"] = ref(record.filename)
+    if record.link:
+        mbfile["Target"] = ref(record.link)
+    if record.hash:
+        mbfile["Digest"] = ref(record.hash)
+    if record.key:
+        data_class = ref({"$classname": "NSMutableData", "$classes": ["NSMutableData", "NSData", "NSObject"]})
+        mbfile["EncryptionKey"] = ref({"NS.data": record.key, "$class": data_class})
+    if record.properties:
+        attributes = {name: value.encode("utf-8") for name, value in record.properties}
+        mbfile["ExtendedAttributes"] = ref(plistlib.dumps(attributes, fmt=plistlib.FMT_BINARY))
+    mbfile["$class"] = ref({"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]})
+
+    return plistlib.dumps({
+        "$version": 100000,
+        "$archiver": "NSKeyedArchiver",
+        "$top": {"root": plistlib.UID(1)},
+        "$objects": objects,
+    }, fmt=plistlib.FMT_BINARY)
+
+def _unarchive_record(domain: str, relative_path: str, data: bytes) -> MbdbRecord:
+    archive = plistlib.loads(data)
+    objects = archive["$objects"]
+
+    def deref(value):
+        return objects[value.data] if isinstance(value, plistlib.UID) else value
+
+    mbfile = deref(archive["$top"]["root"])
+    key = deref(mbfile.get("EncryptionKey", b""))
+    if isinstance(key, dict):
+        key = key["NS.data"]
+    properties = []
+    if "ExtendedAttributes" in mbfile:
+        attributes = plistlib.loads(deref(mbfile["ExtendedAttributes"]))
+        properties = [(name, value.decode("utf-8")) for name, value in attributes.items()]
+
+    return MbdbRecord(
+        domain=domain,
+        filename=relative_path,
+        link=deref(mbfile.get("Target", "")),
+        hash=deref(mbfile.get("Digest", b"")),
+        key=key,
+        mode=mbfile.get("Mode", 0),
+        inode=mbfile.get("InodeNumber", 0),
+        user_id=mbfile.get("UserID", 0),
+        group_id=mbfile.get("GroupID", 0),
+        mtime=mbfile.get("LastModified", 0),
+        # Manifest.db does not keep access times
+        atime=mbfile.get("LastModified", 0),
+        ctime=mbfile.get("LastStatusChange", 0),
+        size=mbfile.get("Size", 0),
+        flags=mbfile.get("Flags", 0),
+        properties=properties
+    )
+
+class ManifestDb:
+    # SQLite manifest of modern backups, exposes the same record API as Mbdb and MbdbIndex
+    # with the lookups answered by indexed queries; an existing database is opened read-only unless writable is
+    # asked for, and only create() lays out the schema, so opening a backup never changes its Manifest.db
+    def __init__(self, path: Path, writable: bool = False, create: bool = False):
+        self.path = Path(path)
+        self.writable = writable or create
+        mode = "rwc" if create else "rw" if writable else "ro"
+        self._db = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode={mode}", uri=True)
+        if create:
+            self._db.executescript(_SCHEMA)
+
+    @classmethod
+    def open(cls, path: Path, writable: bool = False) -> "ManifestDb":
+        return cls(path, writable=writable)
+
+    @classmethod
+    def create(cls, path: Path) -> "ManifestDb":
+        return cls(path, create=True)
+
+    @classmethod
+    def from_mbdb(cls, path: Path, mbdb: Mbdb) -> "ManifestDb":
+        manifest = cls.create(path)
+        manifest.extend(mbdb.records)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.writable:
+            self._db.commit()
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def _records(self, query: str, args: tuple = ()):
+        for domain, relative_path, data in self._db.execute(f"SELECT domain, relativePath, file FROM Files {query}", args):
+            yield _unarchive_record(domain, relative_path, data)
+
+    @property
+    def records(self) -> list[MbdbRecord]:
+        return list(self)
+
+    def to_mbdb(self) -> Mbdb:
+        return Mbdb(self.records)
+
+    def __iter__(self):
+        return self._records("ORDER BY rowid")
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM Files").fetchone()[0]
+
+    def __contains__(self, key: tuple) -> bool:
+        return self._db.execute("SELECT 1 FROM Files WHERE domain = ? AND relativePath = ?", key).fetchone() is not None
+
+    def add(self, record: MbdbRecord):
+        self.extend((record,))
+
+    def extend(self, records):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO Files (fileID, domain, relativePath, flags, file) VALUES (?, ?, ?, ?, ?)",
+                ((
+                    file_id(record.domain, record.filename),
+                    record.domain,
+                    record.filename,
+                    _flags_for(record.mode),
+                    _archive_record(record)
+                ) for record in records)
+            )
+
+    def remove(self, record: MbdbRecord):
+        with self._db:
+            self._db.execute("DELETE FROM Files WHERE fileID = ?", (file_id(record.domain, record.filename),))
+
+    def get(self, domain: str, filename: str) -> Optional[MbdbRecord]:
+        return next(self._records("WHERE domain = ? AND relativePath = ?", (domain, filename)), None)
+
+    def by_file_id(self, file_id: str) -> Optional[MbdbRecord]:
+        return next(self._records("WHERE fileID = ?", (file_id,)), None)
+
+    def under(self, domain: str, path: str) -> list[MbdbRecord]:
+        # same contract as MbdbIndex.under, the range keeps the query on the domain/path index
+        path = path.rstrip("/")
+        if not path:
+            return list(self._records("WHERE domain = ? ORDER BY relativePath", (domain,)))
+        return [
+            record for record in self._records(
+                "WHERE domain = ? AND relativePath >= ? AND relativePath < ? ORDER BY relativePath",
+                (domain, path, path + "0")
+            )
+            if record.filename == path or record.filename.startswith(path + "/")
+        ]
+
+    def in_domain(self, domain: str) -> list[MbdbRecord]:
+        return list(self._records("WHERE domain = ? ORDER BY rowid", (domain,)))
+
+    def get_property(self, key: str) -> Optional[bytes]:
+        row = self._db.execute("SELECT value FROM Properties WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_property(self, key: str, value: bytes):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO Properties (key, value) VALUES (?, ?)", (key, value))
@@ -1,5 +1,20 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
 from io import BytesIO
+from array import array
+from bisect import bisect_left, insort
+from hashlib import sha1
+from typing import Optional
+from pathlib import Path
+import gc
+import mmap
+import struct
+
+# numpy is only needed for MbdbTable, it is an optional extra: pip install -r requirements-table.txt
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Mode bitfield
 from enum import IntFlag
@@ -32,7 +47,53 @@ class _FileMode(IntFlag):
     S_ISGID  = 0o0002000
     S_ISVTX  = 0o0001000
 
-@dataclass
+# precompiled layout for the fixed-width tail of a record:
+# mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties_count
+_TAIL = struct.Struct(">HQIIIIIQBB")
+_LENGTH = struct.Struct(">H")
+_HEADER = b"mbdb\x05\x00"
+
+@lru_cache(maxsize=1 << 16)
+def file_id(domain: str, filename: str) -> str:
+    # name of the payload for a file inside the backup directory
+    return sha1((domain + "-" + filename).encode()).digest().hex()
+
+@lru_cache(maxsize=4096)
+def _record_layout(domain_len: int, filename_len: int, link_len: int, hash_len: int, key_len: int) -> struct.Struct:
+    # one layout per combination of string lengths so that a record (minus its properties) packs in a single call
+    return struct.Struct(f">H{domain_len}sH{filename_len}sH{link_len}sH{hash_len}sH{key_len}s" + _TAIL.format[1:])
+
+def _check_header(buf):
+    if buf[:4] != _HEADER[:4]:
+        raise ValueError("Invalid MBDB file")
+
+    if buf[4:6] != _HEADER[4:]:
+        raise ValueError("Invalid MBDB version")
+
+def _tail_offset(buf, offset: int) -> int:
+    # skips the five length-prefixed fields at the start of a record
+    for _ in range(5):
+        n = buf[offset] << 8 | buf[offset + 1]
+        offset += 2
+        if n != 0xffff:
+            offset += n
+    return offset
+
+def _record_end(buf, offset: int) -> int:
+    # walks over a record without decoding it, used to build offset tables
+    offset = _tail_offset(buf, offset)
+    properties_count = buf[offset + _TAIL.size - 1]
+    offset += _TAIL.size
+    for _ in range(properties_count * 2):
+        n = buf[offset] << 8 | buf[offset + 1]
+        offset += 2
+        if n != 0xffff:
+            offset += n
+    if offset > len(buf):
+        raise ValueError("Truncated MBDB record")
+    return offset
+
+@dataclass(slots=True)
 class MbdbRecord:
     domain: str
     filename: str
@@ -94,75 +155,777 @@ class MbdbRecord:
             properties.append((name, value))
 
         return cls(domain, filename, link, hash, key, mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties)
+
+    @classmethod
+    def from_buffer(cls, buf, offset: int):
+        # parses a record in place from bytes, an mmap or a memoryview, returns the record and the offset right after it
+        # mode is kept as the raw int here, use file_mode to get the decoded flags
+        p = offset + 2 + (buf[offset] << 8 | buf[offset + 1])
+        domain = str(buf[offset + 2:p], "utf-8")
+        offset = p + 2 + (buf[p] << 8 | buf[p + 1])
+        filename = str(buf[p + 2:offset], "utf-8")
+
+        n = buf[offset] << 8 | buf[offset + 1]
+        if n == 0xffff or n == 0:
+            link = ""
+            offset += 2
+        else:
+            link = str(buf[offset + 2:offset + 2 + n], "utf-8")
+            offset += 2 + n
+
+        n = buf[offset] << 8 | buf[offset + 1]
+        if n == 0xffff:
+            hash = b""
+            offset += 2
+        else:
+            hash = bytes(buf[offset + 2:offset + 2 + n])
+            offset += 2 + n
+
+        n = buf[offset] << 8 | buf[offset + 1]
+        if n == 0xffff:
+            key = b""
+            offset += 2
+        else:
+            key = bytes(buf[offset + 2:offset + 2 + n])
+            offset += 2 + n
+
+        mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties_count = _TAIL.unpack_from(buf, offset)
+        offset += _TAIL.size
+
+        properties = []
+        for _ in range(properties_count):
+            n = buf[offset] << 8 | buf[offset + 1]
+            offset += 2
+            if n != 0xffff:
+                name = str(buf[offset:offset + n], "utf-8")
+                offset += n
+            else:
+                name = ""
+
+            n = buf[offset] << 8 | buf[offset + 1]
+            offset += 2
+            if n != 0xffff:
+                value = str(buf[offset:offset + n], "utf-8")
+                offset += n
+            else:
+                value = ""
+
+            properties.append((name, value))
+
+        return cls(domain, filename, link, hash, key, mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties), offset
+
+    @property
+    def file_mode(self) -> _FileMode:
+        return _FileMode(self.mode)
+
+    @property
+    def is_tombstone(self) -> bool:
+        # records removed in place by MbdbWriter have their mode cleared
+        return self.mode == 0
     
-    def to_bytes(self) -> bytes:
-        d = BytesIO()
+    def encode(self) -> tuple:
+        # encodes the variable-width fields once, returns the exact record size with what pack_into needs
+        domain = self.domain.encode("utf-8")
+        filename = self.filename.encode("utf-8")
+        link = self.link.encode("utf-8")
+        layout = _record_layout(len(domain), len(filename), len(link), len(self.hash), len(self.key))
+        values = (
+            len(domain), domain,
+            len(filename), filename,
+            len(link), link,
+            len(self.hash), self.hash,
+            len(self.key), self.key,
+            self.mode,
+            #self.unknown2,
+            #self.unknown3,
+            self.inode,
+            self.user_id,
+            self.group_id,
+            self.mtime,
+            self.atime,
+            self.ctime,
+            self.size,
+            self.flags,
+            len(self.properties)
+        )
+        size = layout.size
+        properties = []
+        for name, value in self.properties:
+            name = name.encode("utf-8")
+            value = value.encode("utf-8")
+            size += 4 + len(name) + len(value)
+            properties.append((name, value))
+        return size, layout, values, properties
 
-        d.write(len(self.domain).to_bytes(2, "big"))
-        d.write(self.domain.encode("utf-8"))
+    def pack_into(self, buf: bytearray, offset: int, encoded: tuple = None) -> int:
+        # writes the record into buf at offset, returns the offset right after it
+        if encoded is None:
+            encoded = self.encode()
+        _, layout, values, properties = encoded
 
-        d.write(len(self.filename).to_bytes(2, "big"))
-        d.write(self.filename.encode("utf-8"))
+        layout.pack_into(buf, offset, *values)
+        offset += layout.size
 
-        d.write(len(self.link).to_bytes(2, "big"))
-        d.write(self.link.encode("utf-8"))
+        for name, value in properties:
+            _LENGTH.pack_into(buf, offset, len(name))
+            offset += 2
+            buf[offset:offset + len(name)] = name
+            offset += len(name)
 
-        d.write(len(self.hash).to_bytes(2, "big"))
-        d.write(self.hash)
+            _LENGTH.pack_into(buf, offset, len(value))
+            offset += 2
+            buf[offset:offset + len(value)] = value
+            offset += len(value)
 
-        d.write(len(self.key).to_bytes(2, "big"))
-        d.write(self.key)
+        return offset
 
-        d.write(self.mode.to_bytes(2, "big"))
-        #d.write(self.unknown2.to_bytes(4, "big"))
-        #d.write(self.unknown3.to_bytes(4, "big"))
-        d.write(self.inode.to_bytes(8, "big"))
-        d.write(self.user_id.to_bytes(4, "big"))
-        d.write(self.group_id.to_bytes(4, "big"))
-        d.write(self.mtime.to_bytes(4, "big"))
-        d.write(self.atime.to_bytes(4, "big"))
-        d.write(self.ctime.to_bytes(4, "big"))
-        d.write(self.size.to_bytes(8, "big"))
-        d.write(self.flags.to_bytes(1, "big"))
+    def to_bytes(self) -> bytes:
+        encoded = self.encode()
+        buf = bytearray(encoded[0])
+        self.pack_into(buf, 0, encoded)
+        return bytes(buf)
+    
+def _parse_records(buf: bytes) -> list[MbdbRecord]:
+    # every record of a manifest, read the way MbdbRecord.from_buffer reads one but without a call per record:
+    # strings are sliced straight out of buf and the fixed-width tail is one precompiled unpack
+    records = []
+    append = records.append
+    record = MbdbRecord
+    unpack_tail = _TAIL.unpack_from
+    tail_size = _TAIL.size
+    # a manifest only has a handful of domains, each is decoded once
+    domains = {}
+    offset = 6
+    end = len(buf)
+    try:
+        while offset < end:
+            p = offset + 2 + (buf[offset] << 8 | buf[offset + 1])
+            raw = buf[offset + 2:p]
+            domain = domains.get(raw)
+            if domain is None:
+                domain = domains[raw] = raw.decode("utf-8")
+            offset = p + 2 + (buf[p] << 8 | buf[p + 1])
+            filename = buf[p + 2:offset].decode("utf-8")
+
+            # 0xffff stands for an empty field without any bytes
+            n = buf[offset] << 8 | buf[offset + 1]
+            if n == 0xffff or n == 0:
+                link = ""
+                offset += 2
+            else:
+                offset += 2 + n
+                link = buf[offset - n:offset].decode("utf-8")
+
+            n = buf[offset] << 8 | buf[offset + 1]
+            if n == 0xffff:
+                hash = b""
+                offset += 2
+            else:
+                offset += 2 + n
+                hash = buf[offset - n:offset]
+
+            n = buf[offset] << 8 | buf[offset + 1]
+            if n == 0xffff:
+                key = b""
+                offset += 2
+            else:
+                offset += 2 + n
+                key = buf[offset - n:offset]
+
+            mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties_count = unpack_tail(buf, offset)
+            offset += tail_size
+
+            properties = []
+            if properties_count:
+                for _ in range(properties_count):
+                    n = buf[offset] << 8 | buf[offset + 1]
+                    offset += 2
+                    if n != 0xffff:
+                        name = buf[offset:offset + n].decode("utf-8")
+                        offset += n
+                    else:
+                        name = ""
+
+                    n = buf[offset] << 8 | buf[offset + 1]
+                    offset += 2
+                    if n != 0xffff:
+                        value = buf[offset:offset + n].decode("utf-8")
+                        offset += n
+                    else:
+                        value = ""
+
+                    properties.append((name, value))
+
+            append(record(domain, filename, link, hash, key, mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, properties))
+    except (struct.error, IndexError):
+        raise ValueError("Truncated MBDB record")
+    if offset > end:
+        raise ValueError("Truncated MBDB record")
+    return records
+
+class MbdbIndex:
+    # lookups by (domain, filename) and by file id, plus a sorted list of filenames per domain for prefix queries
+    def __init__(self, records: list[MbdbRecord] = ()):
+        self._by_path = {}
+        self._by_file_id = {}
+        self._filenames = {}
+        for record in records:
+            self._insert(record)
+        for filenames in self._filenames.values():
+            filenames.sort()
+
+    def _insert(self, record: MbdbRecord) -> bool:
+        key = (record.domain, record.filename)
+        new = key not in self._by_path
+        self._by_path[key] = record
+        self._by_file_id[file_id(record.domain, record.filename)] = record
+        if new:
+            self._filenames.setdefault(record.domain, []).append(record.filename)
+        return new
+
+    def add(self, record: MbdbRecord):
+        if self._insert(record):
+            filenames = self._filenames[record.domain]
+            filenames.pop()
+            insort(filenames, record.filename)
+
+    def remove(self, record: MbdbRecord):
+        key = (record.domain, record.filename)
+        # a later record with the same path may have replaced this one already
+        if self._by_path.get(key) is not record:
+            return
+        del self._by_path[key]
+        del self._by_file_id[file_id(record.domain, record.filename)]
+        filenames = self._filenames[record.domain]
+        del filenames[bisect_left(filenames, record.filename)]
+
+    def get(self, domain: str, filename: str) -> Optional[MbdbRecord]:
+        return self._by_path.get((domain, filename))
+
+    def by_file_id(self, file_id: str) -> Optional[MbdbRecord]:
+        return self._by_file_id.get(file_id)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._by_path
+
+    def __len__(self) -> int:
+        return len(self._by_path)
+
+    def under(self, domain: str, path: str) -> list[MbdbRecord]:
+        # the record for path itself (if any) followed by everything below it, in filename order
+        filenames = self._filenames.get(domain, [])
+        path = path.rstrip("/")
+        if path:
+            # "0" sorts right after "/", so the children of path are one contiguous run
+            start = bisect_left(filenames, path)
+            end = bisect_left(filenames, path + "0")
+            matches = (filename for filename in filenames[start:end] if filename == path or filename.startswith(path + "/"))
+        else:
+            matches = filenames
+        return [self._by_path[(domain, filename)] for filename in matches]
+
+_DELTA_HEADER = b"mbdd\x01\x00"
+_DELTA_REMOVED = 0
+_DELTA_ADDED = 1
+_DELTA_MODIFIED = 2
 
-        d.write(len(self.properties).to_bytes(1, "big"))
+@dataclass
+class MbdbDelta:
+    # changes between two manifests, records are keyed by (domain, filename)
+    added: list[MbdbRecord]
+    removed: list[tuple[str, str]]
+    modified: list[MbdbRecord]
 
-        for name, value in self.properties:
-            d.write(len(name).to_bytes(2, "big"))
-            d.write(name.encode("utf-8"))
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed) + len(self.modified)
 
-            d.write(len(value).to_bytes(2, "big"))
-            d.write(value.encode("utf-8"))
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        buf = memoryview(data).cast("B")
+        if buf[:6] != _DELTA_HEADER:
+            raise ValueError("Invalid MBDB delta")
+
+        delta = cls([], [], [])
+        offset = 6
+        try:
+            while offset < len(buf):
+                op = buf[offset]
+                offset += 1
+                if op == _DELTA_REMOVED:
+                    key = []
+                    for _ in range(2):
+                        n = buf[offset] << 8 | buf[offset + 1]
+                        offset += 2
+                        key.append(str(buf[offset:offset + n], "utf-8"))
+                        offset += n
+                    delta.removed.append(tuple(key))
+                elif op == _DELTA_ADDED or op == _DELTA_MODIFIED:
+                    record, offset = MbdbRecord.from_buffer(buf, offset)
+                    (delta.added if op == _DELTA_ADDED else delta.modified).append(record)
+                else:
+                    raise ValueError(f"Unknown MBDB delta entry {op}")
+        except (struct.error, IndexError):
+            raise ValueError("Truncated MBDB delta")
+        return delta
 
+    def to_bytes(self) -> bytes:
+        # removed entries only carry their key, the others reuse the manifest record layout
+        d = BytesIO()
+        d.write(_DELTA_HEADER)
+        for domain, filename in self.removed:
+            domain = domain.encode("utf-8")
+            filename = filename.encode("utf-8")
+            d.write(bytes((_DELTA_REMOVED,)))
+            d.write(_LENGTH.pack(len(domain)))
+            d.write(domain)
+            d.write(_LENGTH.pack(len(filename)))
+            d.write(filename)
+        for op, records in ((_DELTA_ADDED, self.added), (_DELTA_MODIFIED, self.modified)):
+            for record in records:
+                d.write(bytes((op,)))
+                d.write(record.to_bytes())
         return d.getvalue()
-    
+
 @dataclass
 class Mbdb:
     records: list[MbdbRecord]
+    _index: Optional[MbdbIndex] = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        d = BytesIO(data)
-
-        if d.read(4) != b"mbdb":
-            raise ValueError("Invalid MBDB file")
-
-        if d.read(2) != b"\x05\x00":
-            raise ValueError("Invalid MBDB version")
+        # slicing and decoding bytes is much cheaper than going through a memoryview, so another buffer (an mmap,
+        # a bytearray) is copied once; the records only keep their own strings, not the buffer
+        buf = data if isinstance(data, bytes) else bytes(data)
+        _check_header(buf)
+        # the parse only builds records, none of which can be part of a reference cycle, so the collector
+        # would just walk the growing list again and again
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            return cls(_parse_records(buf))
+        finally:
+            if collecting:
+                gc.enable()
 
+    @classmethod
+    def open(cls, path: Path, mode: str = "r"):
+        # "r" streams records out of an existing manifest, "a" appends to one (creating it if needed)
+        if mode == "r":
+            return MbdbReader(path)
+        if mode == "a":
+            return MbdbWriter(path)
+        raise ValueError(f"Invalid MBDB open mode {mode!r}")
+
+    @property
+    def index(self) -> MbdbIndex:
+        # built on first use, add() and remove() keep it up to date afterwards
+        if self._index is None:
+            self._index = MbdbIndex(self.records)
+        return self._index
+
+    def add(self, record: MbdbRecord):
+        self.records.append(record)
+        if self._index is not None:
+            self._index.add(record)
+
+    def remove(self, record: MbdbRecord):
+        for i, existing in enumerate(self.records):
+            if existing is record:
+                del self.records[i]
+                break
+        else:
+            raise ValueError("Record is not in this MBDB")
+        if self._index is not None:
+            self._index.remove(record)
+            # bring back an earlier record with the same path that this one was shadowing
+            for existing in reversed(self.records):
+                if existing.domain == record.domain and existing.filename == record.filename:
+                    self._index.add(existing)
+                    break
+
+    def diff(self, other: "Mbdb") -> MbdbDelta:
+        # what has to change to turn this manifest into other
+        old = {(record.domain, record.filename): record for record in self.records}
+        added = []
+        modified = []
+        for record in other.records:
+            existing = old.pop((record.domain, record.filename), None)
+            if existing is None:
+                added.append(record)
+            elif existing != record:
+                modified.append(record)
+        return MbdbDelta(added=added, removed=list(old), modified=modified)
+
+    def apply_patch(self, delta: MbdbDelta) -> "Mbdb":
+        # records keep their current order, modified ones are replaced in place and added ones go at the end
+        removed = set(delta.removed)
+        modified = {(record.domain, record.filename): record for record in delta.modified}
         records = []
-        while d.tell() < len(data):
-            records.append(MbdbRecord.from_stream(d))
-
-        return cls(records)
+        found = 0
+        for record in self.records:
+            key = (record.domain, record.filename)
+            if key in removed:
+                found += 1
+                continue
+            replacement = modified.get(key)
+            if replacement is not None:
+                found += 1
+                record = replacement
+            records.append(record)
+        if found != len(removed) + len(modified):
+            raise ValueError("MBDB delta does not apply to this manifest")
+        records.extend(delta.added)
+        return Mbdb(records)
     
-    def to_bytes(self) -> bytes:
-        d = BytesIO()
+    def to_bytes(self) -> bytearray:
+        # size the whole manifest up front and fill a single buffer, which is returned as is to avoid another copy
+        encoded = [record.encode() for record in self.records]
+        buf = bytearray(len(_HEADER) + sum(record_encoded[0] for record_encoded in encoded))
+        buf[:len(_HEADER)] = _HEADER
+        offset = len(_HEADER)
+        for record, record_encoded in zip(self.records, encoded):
+            offset = record.pack_into(buf, offset, record_encoded)
+        return buf
+
+    def write_to(self, f) -> int:
+        # streams the manifest to an open binary file one record at a time, returns the number of bytes written
+        f.write(_HEADER)
+        written = len(_HEADER)
+        buf = bytearray()
+        for record in self.records:
+            encoded = record.encode()
+            if len(buf) < encoded[0]:
+                buf = bytearray(encoded[0])
+            record.pack_into(buf, 0, encoded)
+            with memoryview(buf) as view:
+                f.write(view[:encoded[0]])
+            written += encoded[0]
+        return written
+
+class MbdbReader:
+    # memory-maps a Manifest.mbdb and decodes records only when they are asked for
+    # the offset of every record seen so far is kept so that indexing does not have to parse from the start
+    def __init__(self, path: Path):
+        self._file = open(path, "rb")
+        try:
+            _check_header(self._file.read(6))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        self._offsets = array("Q")
+        self._end = len(self._map)
+        self._indexed = self._end == 6
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __iter__(self):
+        buf = self._map
+        offsets = self._offsets
+        offset = 6
+        index = 0
+        try:
+            while offset < self._end:
+                if index == len(offsets):
+                    offsets.append(offset)
+                record, offset = MbdbRecord.from_buffer(buf, offset)
+                index += 1
+                yield record
+        except (struct.error, IndexError):
+            raise ValueError("Truncated MBDB record")
+        self._indexed = True
+
+    def _index_to(self, index: int):
+        # extends the offset table until it covers the given index (or the whole file for -1)
+        if self._indexed:
+            return
+        offsets = self._offsets
+        offset = _record_end(self._map, offsets[-1]) if offsets else 6
+        while not self._indexed and (index < 0 or len(offsets) <= index):
+            if offset >= self._end:
+                self._indexed = True
+                break
+            offsets.append(offset)
+            try:
+                offset = _record_end(self._map, offset)
+            except IndexError:
+                raise ValueError("Truncated MBDB record")
+
+    def __len__(self) -> int:
+        self._index_to(-1)
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> MbdbRecord:
+        if index < 0:
+            index += len(self)
+        elif index >= len(self._offsets):
+            self._index_to(index)
+        if not 0 <= index < len(self._offsets):
+            raise IndexError("MBDB record index out of range")
+        try:
+            return MbdbRecord.from_buffer(self._map, self._offsets[index])[0]
+        except (struct.error, IndexError):
+            raise ValueError("Truncated MBDB record")
+
+    def to_mbdb(self) -> Mbdb:
+        return Mbdb(list(self))
+
+class MbdbWriter:
+    # appends records to a manifest and removes them in place, so small changes never re-serialize the whole file
+    # removed records are tombstoned by clearing their mode, call compact() before handing the manifest to a device
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            with open(self.path, "wb") as f:
+                f.write(_HEADER)
+        self._file = open(self.path, "r+b")
+        try:
+            _check_header(self._file.read(6))
+        except BaseException:
+            self._file.close()
+            raise
+        self._end = self._file.seek(0, 2)
+        # (domain, filename) -> offsets of the live records, only built once something gets tombstoned
+        self._offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def flush(self):
+        self._file.flush()
+
+    def _scan(self) -> dict:
+        self._file.flush()
+        offsets = {}
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = 6
+            try:
+                while offset < self._end:
+                    record, end = MbdbRecord.from_buffer(buf, offset)
+                    if not record.is_tombstone:
+                        offsets.setdefault((record.domain, record.filename), []).append(offset)
+                    offset = end
+            except (struct.error, IndexError):
+                raise ValueError("Truncated MBDB record")
+        return offsets
+
+    def append(self, record: MbdbRecord):
+        self.extend((record,))
+
+    def extend(self, records):
+        self._file.seek(self._end)
+        buf = bytearray()
+        for record in records:
+            encoded = record.encode()
+            if len(buf) < encoded[0]:
+                buf = bytearray(encoded[0])
+            record.pack_into(buf, 0, encoded)
+            with memoryview(buf) as view:
+                self._file.write(view[:encoded[0]])
+            if self._offsets is not None:
+                self._offsets.setdefault((record.domain, record.filename), []).append(self._end)
+            self._end += encoded[0]
+
+    def tombstone(self, domain: str, filename: str) -> int:
+        # returns how many records were removed
+        if self._offsets is None:
+            self._offsets = self._scan()
+        offsets = self._offsets.pop((domain, filename), [])
+        if offsets:
+            self._file.flush()
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                tails = [_tail_offset(buf, offset) for offset in offsets]
+            for tail in tails:
+                self._file.seek(tail)
+                self._file.write(b"\x00\x00")
+        return len(offsets)
+
+    def compact(self):
+        # rewrites the manifest without its tombstones
+        self._file.flush()
+        with MbdbReader(self.path) as reader:
+            manifest = Mbdb([record for record in reader if not record.is_tombstone])
+        self._file.seek(0)
+        self._end = manifest.write_to(self._file)
+        self._file.truncate()
+        self._offsets = None
+
+class _StringPool:
+    # interned byte strings stored back to back in one blob, id 0 is always the empty string
+    def __init__(self):
+        self._ids = {b"": 0}
+        self._chunks = [b""]
+        self._blob = None
+        self._offsets = None
+
+    def add(self, value: bytes) -> int:
+        id = self._ids.get(value)
+        if id is None:
+            id = self._ids[value] = len(self._chunks)
+            self._chunks.append(value)
+        return id
+
+    def freeze(self):
+        offsets = np.zeros(len(self._chunks) + 1, dtype=np.uint64)
+        np.cumsum([len(chunk) for chunk in self._chunks], out=offsets[1:])
+        self._blob = b"".join(self._chunks)
+        self._offsets = offsets
+        self._chunks = None
+
+    def id_of(self, value: bytes) -> int:
+        # -1 for strings that are not in the pool, which never matches a row
+        return self._ids.get(value, -1)
+
+    def ids_where(self, predicate) -> "np.ndarray":
+        return np.fromiter((id for value, id in self._ids.items() if predicate(value)), dtype=np.int64)
+
+    def __getitem__(self, id: int) -> bytes:
+        return self._blob[self._offsets[id]:self._offsets[id + 1]]
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("MbdbTable needs numpy, install it with: pip install -r requirements-table.txt")
+
+class MbdbTable:
+    # columnar view of a manifest: fixed-width fields live in a numpy structured array,
+    # strings and hashes are ids into a shared pool
+    DTYPE = np.dtype([
+        ("mode", np.uint16),
+        ("inode", np.uint64),
+        ("user_id", np.uint32),
+        ("group_id", np.uint32),
+        ("mtime", np.uint32),
+        ("atime", np.uint32),
+        ("ctime", np.uint32),
+        ("size", np.uint64),
+        ("flags", np.uint8),
+        ("domain", np.uint32),
+        ("filename", np.uint32),
+        ("link", np.uint32),
+        ("hash", np.uint32),
+        ("key", np.uint32),
+        ("properties", np.uint32),
+    ]) if np is not None else None
+
+    def __init__(self, rows: "np.ndarray", pool: _StringPool, properties: list):
+        _require_numpy()
+        self.rows = rows
+        self._pool = pool
+        # index 0 is the shared "no properties" entry
+        self._properties = properties
 
-        d.write(b"mbdb")
-        d.write(b"\x05\x00")
+    @classmethod
+    def from_records(cls, records) -> "MbdbTable":
+        _require_numpy()
+        pool = _StringPool()
+        add = pool.add
+        properties = [[]]
+
+        def row(record: MbdbRecord) -> tuple:
+            if record.properties:
+                properties.append(list(record.properties))
+                properties_id = len(properties) - 1
+            else:
+                properties_id = 0
+            return (
+                record.mode, record.inode, record.user_id, record.group_id,
+                record.mtime, record.atime, record.ctime, record.size, record.flags,
+                add(record.domain.encode("utf-8")),
+                add(record.filename.encode("utf-8")),
+                add(record.link.encode("utf-8")),
+                add(record.hash),
+                add(record.key),
+                properties_id
+            )
+
+        rows = np.fromiter((row(record) for record in records), dtype=cls.DTYPE)
+        pool.freeze()
+        return cls(rows, pool, properties)
 
-        for record in self.records:
-            d.write(record.to_bytes())
+    @classmethod
+    def from_mbdb(cls, mbdb: Mbdb) -> "MbdbTable":
+        return cls.from_records(mbdb.records)
 
-        return d.getvalue()
\ No newline at end of file
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MbdbTable":
+        # records are decoded one at a time and dropped once they are in the table
+        buf = memoryview(data).cast("B")
+        _check_header(buf)
+
+        def records():
+            offset = 6
+            try:
+                while offset < len(buf):
+                    record, offset = MbdbRecord.from_buffer(buf, offset)
+                    yield record
+            except (struct.error, IndexError):
+                raise ValueError("Truncated MBDB record")
+
+        return cls.from_records(records())
+
+    def to_mbdb(self) -> Mbdb:
+        return Mbdb(list(self))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _record(self, row: tuple) -> MbdbRecord:
+        mode, inode, user_id, group_id, mtime, atime, ctime, size, flags, domain, filename, link, hash, key, properties = row
+        pool = self._pool
+        return MbdbRecord(
+            str(pool[domain], "utf-8"),
+            str(pool[filename], "utf-8"),
+            str(pool[link], "utf-8"),
+            pool[hash],
+            pool[key],
+            mode, inode, user_id, group_id, mtime, atime, ctime, size, flags,
+            list(self._properties[properties])
+        )
+
+    def __iter__(self):
+        for row in self.rows.tolist():
+            yield self._record(row)
+
+    def __getitem__(self, key):
+        # an int gives back a record, a slice, index array or boolean mask gives a filtered table
+        if isinstance(key, (int, np.integer)):
+            return self._record(self.rows[key].tolist())
+        return MbdbTable(self.rows[key], self._pool, self._properties)
+
+    def file_type(self, file_type: _FileMode) -> "np.ndarray":
+        return (self.rows["mode"] & _FileMode.S_IFMT) == file_type
+
+    def regular_files(self) -> "np.ndarray":
+        return self.file_type(_FileMode.S_IFREG)
+
+    def directories(self) -> "np.ndarray":
+        return self.file_type(_FileMode.S_IFDIR)
+
+    def symlinks(self) -> "np.ndarray":
+        return self.file_type(_FileMode.S_IFLNK)
+
+    def in_domain(self, domain: str) -> "np.ndarray":
+        return self.rows["domain"] == self._pool.id_of(domain.encode("utf-8"))
+
+    def under_path(self, prefix: str) -> "np.ndarray":
+        # matches the path itself and everything below it
+        prefix = prefix.rstrip("/").encode("utf-8")
+        ids = self._pool.ids_where(lambda value: value == prefix or value.startswith(prefix + b"/") or not prefix)
+        return np.isin(self.rows["filename"], ids)
+
+    def larger_than(self, size: int) -> "np.ndarray":
+        return self.rows["size"] > size
@@ -1,114 +1,227 @@
-from . import backup, perform_restore
+from . import backup, perform_restore, perform_restore_many, DeviceRestoreResult
+from .cache import StagedBackupCache
+from .mbdb import _FileMode
 from pymobiledevice3.lockdown import LockdownClient
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
 import os
+import posixpath
+import stat
+from typing import Iterable, Union
 
 class FileToRestore:
-    def __init__(self, contents: str, restore_path: str, domain: str = None, owner: int = 501, group: int = 501):
+    # contents can be bytes, a path to the payload on disk, or an iterable of byte chunks
+    def __init__(self, contents: Union[bytes, str, os.PathLike, Iterable[bytes]], restore_path: str, domain: str = None, owner: int = 501, group: int = 501, mode: int = None):
         self.contents = contents
         self.restore_path = restore_path
         self.domain = domain
         self.owner = owner
         self.group = group
+        self.mode = mode
 
-def concat_exploit_file(file: FileToRestore, files_list: list[FileToRestore], last_domain: str) -> str:
+    def _attributes(self) -> dict:
+        attributes = {"owner": self.owner, "group": self.group}
+        if self.mode is not None:
+            attributes["mode"] = _FileMode(self.mode)
+        return attributes
+
+    def to_backup_file(self, path: str, domain: str) -> backup.BackupFile:
+        # called once per file of a plan, the common case skips building the attribute dict
+        if self.mode is None:
+            return backup.concrete_file(path, domain, self.contents, owner=self.owner, group=self.group)
+        return backup.concrete_file(path, domain, self.contents, **self._attributes())
+
+class SymlinkToRestore(FileToRestore):
+    def __init__(self, target: str, restore_path: str, domain: str = None, owner: int = 501, group: int = 501, mode: int = None):
+        super().__init__(None, restore_path, domain, owner, group, mode)
+        self.target = target
+
+    def to_backup_file(self, path: str, domain: str) -> backup.BackupFile:
+        return backup.SymbolicLink(path, domain, self.target, **self._attributes())
+
+class DirectoryToRestore(FileToRestore):
+    # only needed to give a directory its own owner and mode, parents of restored files are created anyway
+    def __init__(self, restore_path: str, domain: str = None, owner: int = 501, group: int = 501, mode: int = None):
+        super().__init__(None, restore_path, domain, owner, group, mode)
+
+    def to_backup_file(self, path: str, domain: str) -> backup.BackupFile:
+        return backup.Directory(path, domain, **self._attributes())
+
+def exploit_domain_path(restore_path: str) -> tuple[str, str]:
     base_path = "/var/backup"
     # set it to work in the separate volumes (prevents a bootloop)
-    if file.restore_path.startswith("/var/mobile/"):
+    if restore_path.startswith("/var/mobile/"):
         # required on iOS 17.0+ since /var/mobile is on a separate partition
         base_path = "/var/mobile/backup"
-    elif file.restore_path.startswith("/private/var/mobile/"):
+    elif restore_path.startswith("/private/var/mobile/"):
         base_path = "/private/var/mobile/backup"
-    elif file.restore_path.startswith("/private/var/"):
+    elif restore_path.startswith("/private/var/"):
         base_path = "/private/var/backup"
-    # don't append the directory if it has already been added (restore will fail)
-    path, name = os.path.split(file.restore_path)
-    domain_path = f"SysContainerDomain-../../../../../../../..{base_path}{path}/"
-    new_last_domain = last_domain
-    if last_domain != domain_path:
-        files_list.append(backup.Directory(
-            "",
-            f"{domain_path}/",
-            owner=file.owner,
-            group=file.group
-        ))
-        new_last_domain = domain_path
-    files_list.append(backup.ConcreteFile(
-        "",
-        f"{domain_path}/{name}",
-        owner=file.owner,
-        group=file.group,
-        contents=file.contents
-    ))
-    return new_last_domain
-
-def concat_regular_file(file: FileToRestore, files_list: list[FileToRestore], last_domain: str, last_path: str):
-    path, name = os.path.split(file.restore_path)
-    paths = path.split("/")
-    new_last_domain = last_domain
-    # append the domain first
-    if last_domain != file.domain:
-        files_list.append(backup.Directory(
-            "",
-            file.domain,
-            owner=file.owner,
-            group=file.group
-        ))
-        new_last_domain = file.domain
-    # append each part of the path if it is not already there
-    full_path = ""
-    for path_item in paths:
-        if full_path != "":
-            full_path += "/"
-        full_path += path_item
-        if not last_path.startswith(full_path):
-            files_list.append(backup.Directory(
-                full_path,
-                file.domain,
-                owner=file.owner,
-                group=file.group
-            ))
-            last_path = full_path
-    # finally, append the file
-    files_list.append(backup.ConcreteFile(
-        f"{full_path}/{name}",
-        file.domain,
-        owner=file.owner,
-        group=file.group,
-        contents=file.contents
-    ))
-    return new_last_domain, full_path
+    path, name = posixpath.split(restore_path)
+    return f"SysContainerDomain-../../../../../../../..{base_path}{path}/", name
 
-# files is a list of FileToRestore objects
-def restore_files(files: list, reboot: bool = False, lockdown_client: LockdownClient = None):
-    # create the files to be backed up
-    files_list = [
-    ]
-    sorted_files = sorted(files, key=lambda x: x.restore_path, reverse=True)
-    # add the file paths
-    last_domain = ""
-    last_path = ""
-    exploit_only = True
-    for file in sorted_files:
-        if file.domain == None:
-            last_domain = concat_exploit_file(file, files_list, last_domain)
+class _PathNode:
+    # one directory of the restore plan, owned by the first file that needed it unless it is restored explicitly
+    __slots__ = ("children", "files", "directory")
+
+    def __init__(self, owner: int, group: int):
+        self.children: dict[str, "_PathNode"] = {}
+        self.files: dict[str, FileToRestore] = {}
+        self.directory = DirectoryToRestore("", owner=owner, group=group)
+
+def _emit_tree(node: _PathNode, path: str, domain: str, files_list: list):
+    files_list.extend(
+        file.to_backup_file(f"{path}/{name}" if path else name, domain)
+        for name, file in node.files.items()
+    )
+    for part, child in node.children.items():
+        child_path = f"{path}/{part}" if path else part
+        files_list.append(child.directory.to_backup_file(child_path, domain))
+        _emit_tree(child, child_path, domain, files_list)
+
+def _where(file: FileToRestore) -> str:
+    return f" in {file.domain}" if file.domain is not None else ""
+
+def plan_restore(files: list[FileToRestore]) -> list[backup.BackupFile]:
+    # builds a path trie per domain so every directory is emitted exactly once and before its contents,
+    # exploit files are grouped by their traversal domain instead since each one restores to a single directory;
+    # the trie decides the order, so the files are taken as they come
+    roots: dict[tuple[bool, str], _PathNode] = {}
+    # every (domain, path) that is restored, whatever its kind, so no path is restored twice
+    seen = set()
+    # (domain, directory path) -> its node, files that share a directory only walk the trie once
+    directories: dict[tuple[str, str], _PathNode] = {}
+    for file in files:
+        is_directory = isinstance(file, DirectoryToRestore)
+        key = (file.domain, file.restore_path.strip("/"))
+        if key in seen:
+            raise ValueError(f"{file.restore_path} is restored more than once{_where(file)}")
+        seen.add(key)
+        if file.domain is None:
+            domain_path, name = exploit_domain_path(file.restore_path.rstrip("/") + "/" if is_directory else file.restore_path)
+            node = roots.get((True, domain_path))
+            if node is None:
+                node = roots[(True, domain_path)] = _PathNode(file.owner, file.group)
         else:
-            last_domain, last_path = concat_regular_file(file, files_list, last_domain, last_path)
-            exploit_only = False
+            path, _, name = file.restore_path.rpartition("/")
+            if is_directory:
+                path, name = file.restore_path, ""
+            node = directories.get((file.domain, path))
+            if node is None:
+                node = roots.get((False, file.domain))
+                if node is None:
+                    node = roots[(False, file.domain)] = _PathNode(file.owner, file.group)
+                for part in path.split("/"):
+                    if not part:
+                        continue
+                    child = node.children.get(part)
+                    if child is None:
+                        if part in node.files:
+                            raise ValueError(f"{file.restore_path} is inside {part}, which is restored as a file{_where(file)}")
+                        child = node.children[part] = _PathNode(file.owner, file.group)
+                    node = child
+                directories[(file.domain, path)] = node
+        if is_directory:
+            node.directory = file
+            continue
+        if name in node.children:
+            raise ValueError(f"{file.restore_path} is restored as a file, but has other paths inside it{_where(file)}")
+        node.files[name] = file
+
+    files_list = []
+    for (exploit, domain), root in roots.items():
+        if exploit:
+            # the directory entry of an exploit domain has to be added once (restore will fail otherwise)
+            files_list.append(root.directory.to_backup_file("", f"{domain}/"))
+            files_list.extend(file.to_backup_file("", f"{domain}/{name}") for name, file in root.files.items())
+        else:
+            # append the domain first, then each directory before its contents
+            files_list.append(root.directory.to_backup_file("", domain))
+            _emit_tree(root, "", domain, files_list)
+    return files_list
+
+def _scan_directory(path: str) -> list[tuple[str, str, os.stat_result, str]]:
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            st = entry.stat(follow_symlinks=False)
+            target = os.readlink(entry.path) if stat.S_ISLNK(st.st_mode) else None
+            entries.append((entry.name, entry.path, st, target))
+    return entries
+
+def import_tree(source: Path, restore_path: str = "", domain: str = None, owner: int = None, group: int = None, workers: int = None) -> list[FileToRestore]:
+    # mirrors the local tree at source to restore_path in domain, or through the exploit when domain is None
+    # modes, owners and symlinks are kept (owner and group override the ones on disk), payloads stay on disk until staging
+    source = Path(source)
+    restore_path = restore_path.rstrip("/")
+    if domain is None and not restore_path.startswith("/"):
+        raise ValueError("Exploit restore paths have to be absolute")
+    root_stat = os.stat(source)
+    if not stat.S_ISDIR(root_stat.st_mode):
+        raise NotADirectoryError(f"{source} is not a directory")
+
+    def attributes(st: os.stat_result) -> dict:
+        return {
+            "domain": domain,
+            "owner": st.st_uid if owner is None else owner,
+            "group": st.st_gid if group is None else group,
+            "mode": stat.S_IMODE(st.st_mode)
+        }
+
+    files = []
+    if restore_path:
+        files.append(DirectoryToRestore(restore_path, **attributes(root_stat)))
+    # directories are scanned as soon as they are found, so deep and wide trees both keep the pool busy
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_directory, source): restore_path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent = pending.pop(future)
+                for name, path, st, target in future.result():
+                    child_path = f"{parent}/{name}" if parent else name
+                    if stat.S_ISDIR(st.st_mode):
+                        files.append(DirectoryToRestore(child_path, **attributes(st)))
+                        pending[pool.submit(_scan_directory, path)] = child_path
+                    elif stat.S_ISLNK(st.st_mode):
+                        files.append(SymlinkToRestore(target, child_path, **attributes(st)))
+                    elif stat.S_ISREG(st.st_mode):
+                        files.append(FileToRestore(Path(path), child_path, **attributes(st)))
+                    # sockets, fifos and device nodes can not be restored
+    # scans finish in any order, sorted the same tree always plans to the same backup (and cache entry)
+    files.sort(key=lambda file: file.restore_path)
+    return files
+
+def plan_backup(files: list, deterministic: bool = False) -> backup.Backup:
+    # create the files to be backed up, duplicates are rejected here before anything is staged
+    files_list = plan_restore(files)
+    exploit_only = all(file.domain is None for file in files)
 
     # crash the restore to skip the setup (only works for exploit files)
     if exploit_only:
         files_list.append(backup.ConcreteFile("", "SysContainerDomain-../../../../../../../.." + "/crash_on_purpose", contents=b""))
 
-    # create the backup
-    back = backup.Backup(files=files_list)
+    return backup.Backup(files=files_list, deterministic=deterministic)
+
+# files is a list of FileToRestore objects
+async def restore_files(files: list, reboot: bool = False, lockdown_client: LockdownClient = None, staging_workers: int = None, staging: str = "disk", cache: StagedBackupCache = None):
+    # cached backups have to be deterministic so that identical file sets share an entry
+    back = plan_backup(files, deterministic=cache is not None)
+
+    return await perform_restore(backup=back, reboot=reboot, lockdown_client=lockdown_client, staging_workers=staging_workers, staging=staging, cache=cache)
+
+# same as restore_files for every device in serials, the backup is staged once and shared;
+# returns a DeviceRestoreResult per serial
+def restore_files_to_devices(files: list, serials: list[str], reboot: bool = False, concurrency: int = 4, staging_workers: int = None, staging: str = "disk", cache: StagedBackupCache = None, wait_ready=None, pool=None) -> dict[str, DeviceRestoreResult]:
+    back = plan_backup(files, deterministic=cache is not None)
 
-    perform_restore(backup=back, reboot=reboot, lockdown_client=lockdown_client)
+    return perform_restore_many(backup=back, serials=serials, reboot=reboot, concurrency=concurrency, staging_workers=staging_workers, staging=staging, cache=cache, wait_ready=wait_ready, pool=pool)
 
 
 # DEPRICATED
-def restore_file(fp: str, restore_path: str, restore_name: str, reboot: bool = False, lockdown_client: LockdownClient = None):
-    # open the file and read the contents
-    contents = open(fp, "rb").read()
+async def restore_file(fp: str, restore_path: str, restore_name: str, reboot: bool = False, lockdown_client: LockdownClient = None):
+    # the contents are streamed from fp while staging instead of being read up front
+    contents = Path(fp)
 
     base_path = "/var/backup"
     if restore_path.startswith("/var/mobile/"):
@@ -127,7 +240,7 @@ def restore_file(fp: str, restore_path: str, restore_name: str, reboot: bool = F
                 owner=501,
                 group=501
             ),
-        backup.ConcreteFile(
+        backup.PathConcreteFile(
                 "",
                 f"SysContainerDomain-../../../../../../../..{base_path}{restore_path}{restore_name}",
                 owner=501,
@@ -146,4 +259,4 @@ def restore_file(fp: str, restore_path: str, restore_name: str, reboot: bool = F
     ])
 
     
-    perform_restore(backup=back, reboot=reboot, lockdown_client=lockdown_client)
\ No newline at end of file
+    await perform_restore(backup=back, reboot=reboot, lockdown_client=lockdown_client)
\ No newline at end of file
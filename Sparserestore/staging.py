@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Optional
+import errno
+import os
+
+from . import backup as backup_module
+
+# tmpfs mounts that are usually there on Linux, the first writable one is used for RAM staging
+RAM_STAGING_ROOTS = ["/dev/shm", "/run/shm"]
+
+@dataclass
+class StagingStats:
+    backend: str # "ram" or "disk"
+    directory: Path
+    seconds: float
+    bytes_written: int
+
+def ram_staging_root() -> Optional[Path]:
+    for root in RAM_STAGING_ROOTS:
+        if os.path.isdir(root) and os.access(root, os.W_OK | os.X_OK):
+            return Path(root)
+    return None
+
+def _directory_size(directory: Path) -> int:
+    # hardlinked payloads only take up space once
+    seen = set()
+    size = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            stat = entry.stat(follow_symlinks=False)
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                size += stat.st_size
+    return size
+
+@contextmanager
+def stage_backup(backup: backup_module.Backup, backend: str = "disk", workers: Optional[int] = None, cache=None):
+    # writes the backup to a temporary directory that lives as long as the context
+    # backend "ram" stages on tmpfs when there is one and falls back to disk when there is not or it fills up
+    # with a StagedBackupCache the directory comes from (and stays in) the cache instead
+    if cache is not None:
+        with cache.staged(backup, workers) as stats:
+            yield stats
+        return
+    if backend not in ("disk", "ram"):
+        raise ValueError(f"Unknown staging backend {backend!r}")
+    roots = []
+    if backend == "ram":
+        root = ram_staging_root()
+        if root is not None:
+            roots.append(root)
+    roots.append(None)
+
+    for root in roots:
+        directory = TemporaryDirectory(dir=root)
+        start = perf_counter()
+        try:
+            backup.write_to_directory(Path(directory.name), workers=workers)
+        except OSError as e:
+            directory.cleanup()
+            if root is None or e.errno != errno.ENOSPC:
+                raise
+            print("Not enough memory to stage the backup in RAM, staging on disk instead")
+            continue
+        stats = StagingStats(
+            backend="disk" if root is None else "ram",
+            directory=Path(directory.name),
+            seconds=perf_counter() - start,
+            bytes_written=_directory_size(Path(directory.name))
+        )
+        with directory:
+            yield stats
+        return
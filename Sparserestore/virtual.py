@@ -0,0 +1,157 @@
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator
+import errno
+import os
+import plistlib
+import posixpath
+import struct
+
+from pymobiledevice3.exceptions import ConnectionTerminatedError
+from pymobiledevice3.services.afc import AfcService
+from pymobiledevice3.services.device_link import DeviceLink, ERRNO_TO_DEVICE_ERROR
+from pymobiledevice3.services.mobilebackup2 import Mobilebackup2Service
+from pymobiledevice3.services.notification_proxy import NotificationProxyService
+
+from . import backup as backup_module
+
+# device link file transfer framing: a big-endian size, then a code byte and the data
+_SIZE = struct.Struct(">I")
+_CODE_SUCCESS = 0x00
+_CODE_ERROR_LOCAL = 0x06
+_CODE_FILE_DATA = 0x0c
+# BackupAgent2 is killed for its memory use when it is sent large frames, so payloads go out in frames of this size
+_FRAME_SIZE = 32 * 1024
+# errno values with an entry in ERRNO_TO_DEVICE_ERROR that mean the same on Linux, Windows and macOS
+_PORTABLE_ERRNOS = (errno.ENOENT, errno.EEXIST, errno.ENOTDIR, errno.EISDIR, errno.EIO, errno.ENOSPC)
+
+class VirtualBackup:
+    # the files of a staged backup directory, produced on demand from a Backup instead of being read from disk
+    def __init__(self, backup: backup_module.Backup):
+        self.backup = backup
+        self._payloads = {}
+        for file in backup.files:
+            if isinstance(file, backup_module.ConcreteFile):
+                # the later file wins, the same as when staging
+                self._payloads[backup.file_id(file)] = file
+        self._metadata = {
+            "Status.plist": backup.generate_status(),
+            "Manifest.plist": backup.generate_manifest(),
+            "Info.plist": plistlib.dumps({}),
+        }
+        self._manifest = None
+
+    @staticmethod
+    def _name(path: str) -> str:
+        # the device asks for paths relative to the backup root, usually prefixed with the source identifier "."
+        return posixpath.normpath(path).lstrip("/")
+
+    def manifest(self) -> bytes:
+        if self._manifest is None:
+            self._manifest = bytes(self.backup.generate_manifest_db().to_bytes())
+        return self._manifest
+
+    def names(self) -> list[str]:
+        return ["Manifest.mbdb", *self._metadata, *self._payloads]
+
+    def __contains__(self, path: str) -> bool:
+        name = self._name(path)
+        return name == "Manifest.mbdb" or name in self._metadata or name in self._payloads
+
+    def size(self, path: str) -> int:
+        name = self._name(path)
+        if name in self._payloads:
+            return self._payloads[name].content_size()
+        return len(b"".join(self.chunks(path)))
+
+    def chunks(self, path: str) -> Iterator[bytes]:
+        name = self._name(path)
+        if name == "Manifest.mbdb":
+            return iter((self.manifest(),))
+        if name in self._metadata:
+            return iter((self._metadata[name],))
+        if name in self._payloads:
+            return self._payloads[name].chunks()
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+class VirtualDeviceLink(DeviceLink):
+    # answers the device's file requests from a VirtualBackup, so nothing is written to disk first
+    # root_path has to be a private empty directory: free disk space queries are answered for it, and whatever
+    # the device asks to upload, move or remove there only ever touches that directory
+    def __init__(self, service, virtual: VirtualBackup, root_path: Path):
+        super().__init__(service, root_path)
+        self.virtual = virtual
+
+    async def _send_frame(self, code: int, data: bytes = b""):
+        await self._sendall(_SIZE.pack(len(data) + 1) + bytes((code,)) + data)
+
+    async def download_files(self, message):
+        status = {}
+        for file in message[1]:
+            name = file.encode()
+            await self._sendall(_SIZE.pack(len(name)) + name)
+            try:
+                for chunk in self.virtual.chunks(file):
+                    with memoryview(chunk) as view:
+                        for start in range(0, len(view), _FRAME_SIZE):
+                            await self._send_frame(_CODE_FILE_DATA, view[start:start + _FRAME_SIZE])
+                await self._send_frame(_CODE_SUCCESS)
+            except OSError as e:
+                # a missing file or a payload that can not be read fails only that file, as DeviceLink does;
+                # the device error codes are keyed by macOS errno values, only these are the same on every host
+                code = e.errno if e.errno in _PORTABLE_ERRNOS else errno.EIO
+                error = e.strerror or os.strerror(code)
+                status[file] = {"DLFileErrorString": error, "DLFileErrorCode": ERRNO_TO_DEVICE_ERROR[code] & 0xffffffffffffffff}
+                await self._send_frame(_CODE_ERROR_LOCAL, error.encode())
+        await self._sendall(_SIZE.pack(0))
+        if status:
+            await self.status_response(-13, "Multi status", status)
+        else:
+            await self.status_response(0)
+
+    async def contents_of_directory(self, message):
+        data = {}
+        if posixpath.normpath(message[1]).strip("/") in (".", ""):
+            for name in self.virtual.names():
+                data[name] = {"DLFileType": "DLFileTypeRegular", "DLFileSize": self.virtual.size(name)}
+        await self.status_response(0, status_dict=data)
+
+class VirtualMobilebackup2Service(Mobilebackup2Service):
+    @asynccontextmanager
+    async def _virtual_link(self, virtual: VirtualBackup):
+        # Mobilebackup2Service.device_link with a VirtualDeviceLink, rooted in a private empty directory
+        await self.connect()
+        with TemporaryDirectory(prefix="quietdaemon-link-") as root_path:
+            dl = VirtualDeviceLink(self._service, virtual, Path(root_path))
+            await dl.version_exchange()
+            await self.version_exchange(dl)
+            try:
+                yield dl
+            finally:
+                # the device may have dropped the link already, which must not replace the error that ended it
+                with suppress(ConnectionTerminatedError):
+                    await dl.disconnect()
+
+    async def restore_virtual(self, virtual: VirtualBackup, system: bool = True, reboot: bool = False, copy: bool = False, settings: bool = True, remove: bool = False, source: str = "."):
+        # the same exchange as Mobilebackup2Service.restore, sync lock included, but with the backup served from
+        # memory; the virtual backup is never encrypted and has no applications to reinstall
+        async with (
+            self._virtual_link(virtual) as dl,
+            NotificationProxyService(self.lockdown) as notification_proxy,
+            AfcService(self.lockdown) as afc,
+            self._backup_lock(afc, notification_proxy),
+        ):
+            await dl.send_process_message({
+                "MessageName": "Restore",
+                "TargetIdentifier": self.lockdown.udid,
+                "SourceIdentifier": source,
+                "Options": {
+                    "RestoreShouldReboot": reboot,
+                    "RestoreDontCopyBackup": not copy,
+                    "RestorePreserveSettings": settings,
+                    "RestoreSystemFiles": system,
+                    "RemoveItemsNotRestored": remove,
+                },
+            })
+            await dl.dl_loop()
@@ -0,0 +1,167 @@
+"""Headless QuietDaemon: applies the tweaks of a job file to the connected devices.
+
+    python cli.py job.json [--dry-run]
+
+A job file (JSON, or TOML on Python 3.11+) looks like
+
+    {
+        "tweaks": ["thermalmonitord", "ota"],
+        "skip_setup": true,
+        "serials": ["00008030-001A2B3C4D5E6F70"],
+        "reboot": true,
+        "wait_ready": true,
+        "concurrency": 4
+    }
+
+"serials" may be left out to target every connected USB device. With "wait_ready" a device only counts as done
+once it is back from its reboot and accepts lockdown again. A JSON report with one entry per device is
+printed when the job is done, the exit code is 1 when any device failed.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+from pathlib import Path
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# nothing from the GUI is imported here, and the device modules are only loaded once the job file is valid
+
+JOB_DEFAULTS = {
+    "tweaks": [],
+    "skip_setup": True,
+    "serials": None,
+    "reboot": True,
+    "concurrency": 4,
+    "timeout": 10,
+    "wait_ready": False,
+}
+
+def load_job(path: Path) -> dict:
+    path = Path(path)
+    if path.suffix == ".toml":
+        if tomllib is None:
+            raise ValueError("TOML job files need Python 3.11 or newer, use JSON instead")
+        job = tomllib.loads(path.read_text())
+    else:
+        job = json.loads(path.read_text())
+    return check_job(job)
+
+def check_job(job: dict) -> dict:
+    # fills in the defaults; tweak names are checked by devicemanagement.tweak_services.check_tweaks
+    if not isinstance(job, dict):
+        raise ValueError("A job file has to contain an object")
+    unknown = job.keys() - JOB_DEFAULTS.keys()
+    if unknown:
+        raise ValueError(f"Unknown job settings: {', '.join(sorted(unknown))}")
+    job = {**JOB_DEFAULTS, **job}
+    if not isinstance(job["tweaks"], list) or not all(isinstance(tweak, str) for tweak in job["tweaks"]):
+        raise ValueError("tweaks has to be a list of tweak names")
+    if job["serials"] is not None and (not isinstance(job["serials"], list) or not all(isinstance(serial, str) for serial in job["serials"])):
+        raise ValueError("serials has to be a list of device serials")
+    for key in ("skip_setup", "reboot", "wait_ready"):
+        if not isinstance(job[key], bool):
+            raise ValueError(f"{key} has to be true or false")
+    # bool is an int too, but true is no concurrency
+    if isinstance(job["concurrency"], bool) or not isinstance(job["concurrency"], int) or job["concurrency"] < 1:
+        raise ValueError("concurrency has to be a whole number of at least 1")
+    if isinstance(job["timeout"], bool) or not isinstance(job["timeout"], (int, float)) or not job["timeout"] > 0:
+        raise ValueError("timeout has to be a number of seconds above 0")
+    return job
+
+async def discover(serials, timeout: float):
+    # the same concurrent handshakes as the GUI, limited to the serials of the job when it names any
+    from pymobiledevice3 import usbmux
+    from devicemanagement.hotplug import connect_device
+
+    connected = [device.serial for device in await usbmux.list_devices() if device.is_usb]
+    targets = connected if serials is None else [serial for serial in serials if serial in connected]
+    errors = {serial: "not connected" for serial in serials or [] if serial not in connected}
+    results = await asyncio.gather(
+        *(asyncio.wait_for(connect_device(serial), timeout) for serial in targets),
+        return_exceptions=True
+    )
+    devices = []
+    for serial, result in zip(targets, results):
+        if isinstance(result, BaseException):
+            errors[serial] = "timed out" if isinstance(result, asyncio.TimeoutError) else str(result)
+        else:
+            devices.append(result)
+    return devices, errors
+
+def run_job(job: dict, dry_run: bool = False) -> dict:
+    from devicemanagement.lockdown_pool import lockdown_pool
+
+    try:
+        # discovery, the restores and the waits share the pool's sessions
+        devices, errors = lockdown_pool.run(discover(job["serials"], job["timeout"]))
+        return apply_job(job, devices, errors, dry_run)
+    finally:
+        lockdown_pool.close()
+
+def apply_job(job: dict, devices: list, errors: dict, dry_run: bool = False, cache=None) -> dict:
+    # applies the job to the supported devices and returns the report, errors holds the serials that were not reached
+    from devicemanagement.tweaks import tweak_files
+    from Sparserestore.restore import restore_files_to_devices
+
+    report = {serial: {"status": "error", "error": error} for serial, error in errors.items()}
+    supported = []
+    for device in devices:
+        report[device.uuid] = {
+            "name": device.name,
+            "version": device.version,
+            "build": device.build,
+            "model": device.model,
+            "status": "ready" if device.supported() else "unsupported",
+        }
+        if device.supported():
+            supported.append(device.uuid)
+
+    if dry_run or not supported:
+        return report
+    wait_ready = None
+    if job["wait_ready"]:
+        from devicemanagement.hotplug import wait_until_ready as wait_ready
+    results = restore_files_to_devices(
+        tweak_files(job["tweaks"], job["skip_setup"]),
+        supported,
+        reboot=job["reboot"],
+        concurrency=job["concurrency"],
+        cache=cache,
+        wait_ready=wait_ready
+    )
+    for serial, result in results.items():
+        report[serial]["status"] = "applied" if result.ok else "error"
+        report[serial]["seconds"] = round(result.seconds, 3)
+        if result.ready_seconds is not None:
+            report[serial]["ready_seconds"] = round(result.ready_seconds, 3)
+        if not result.ok:
+            report[serial]["error"] = str(result.error)
+    return report
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Apply QuietDaemon tweaks without the GUI.")
+    parser.add_argument("job", type=Path, help="JSON or TOML job file")
+    parser.add_argument("--dry-run", action="store_true", help="only discover the devices and report whether they are supported")
+    args = parser.parse_args(argv)
+
+    try:
+        job = load_job(args.job)
+        # the tweak table has no device imports, pymobiledevice3 is only loaded by run_job
+        from devicemanagement.tweak_services import check_tweaks
+        check_tweaks(job["tweaks"])
+    except (OSError, ValueError) as e:
+        print(f"Invalid job file {args.job}: {e}", file=sys.stderr)
+        return 2
+    # progress messages of the restore go to stderr so stdout only holds the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_job(job, args.dry_run)
+    print(json.dumps(report, indent=2))
+    return 1 if any(entry["status"] in ("error", "unsupported") for entry in report.values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
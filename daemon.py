@@ -0,0 +1,323 @@
+"""QuietDaemon station mode: a long running process that applies jobs submitted over HTTP.
+
+    python daemon.py [--port 8765 | --socket /tmp/quietdaemon.sock] [--workers 2]
+
+    POST /jobs        submit a job (the same JSON as a cli.py job file), answers with its record
+    GET  /jobs        every job record
+    GET  /jobs/<id>   one job record, with the report once it is done
+    GET  /devices     the devices that are attached right now
+    GET  /status      workers, queue and cache state
+
+With --profiles, every supported device that attaches gets its profile applied as a job of its own, see
+devicemanagement/profiles.py; a device that already has its profile (on the same build) is left alone.
+
+The device registry and the staged-backup cache stay warm between jobs, and queued jobs are kept on disk so
+they are picked up again after a restart.
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from cli import apply_job, check_job
+from devicemanagement.hotplug import DeviceRegistry, HotplugListener
+from devicemanagement.lockdown_pool import lockdown_pool
+from devicemanagement.profiles import AppliedLedger, AutoApplier, ProfileStore
+from devicemanagement.tweaks import check_tweaks
+from Sparserestore.cache import StagedBackupCache, default_cache_root
+
+def default_state_dir() -> Path:
+    return default_cache_root().parent / "daemon"
+
+class Station:
+    # the warm state of the daemon: device registry, staged-backup cache, job records and the worker pool
+    def __init__(self, state_dir: Path = None, workers: int = 2, cache: StagedBackupCache = None, profiles: ProfileStore = None):
+        self.state_dir = Path(state_dir) if state_dir is not None else default_state_dir()
+        self.jobs_dir = self.state_dir / "jobs"
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.registry = DeviceRegistry()
+        self.cache = cache if cache is not None else StagedBackupCache()
+        self.workers = workers
+        self.jobs = {}
+        self._lock = threading.Lock()
+        # serials a running job is restoring to; a job only starts once none of its devices is busy
+        self._busy = set()
+        self._idle = threading.Condition(self._lock)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._listener = None
+        # with profiles, every supported device that attaches is configured without a submitted job
+        self.auto = None
+        if profiles is not None:
+            self.auto = AutoApplier(profiles, AppliedLedger(self.state_dir / "applied.json"), lambda job, auto_apply: self.submit(job, auto_apply)["id"], self.state_dir / "autoapply.log")
+
+    def start(self):
+        self._load()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        hotplug = threading.Thread(target=self._listen, daemon=True)
+        hotplug.start()
+        self._threads.append(hotplug)
+
+    def stop(self):
+        for _ in range(self.workers):
+            self._queue.put(None)
+        if self._listener is not None:
+            self._listener.cancel()
+
+    def _path(self, job_id: str) -> Path:
+        return self.jobs_dir / f"{job_id}.json"
+
+    def _save(self, record: dict):
+        # written next to the record and renamed into place so a crash never leaves half of it behind
+        path = self._path(record["id"])
+        temp = path.with_name(f".{path.name}.{threading.get_ident()}")
+        temp.write_text(json.dumps(record, indent=1))
+        os.replace(temp, path)
+
+    def _load(self):
+        # jobs that were queued or running when the daemon stopped are queued again, oldest first; the ones
+        # the auto applier submitted are handed back to it so their outcome still reaches the ledger
+        records = []
+        for path in self.jobs_dir.glob("*.json"):
+            try:
+                records.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                print(f"Skipping unreadable job record {path}", file=sys.stderr)
+        records.sort(key=lambda record: record["submitted"])
+        with self._lock:
+            for record in records:
+                self.jobs[record["id"]] = record
+                if record["status"] in ("queued", "running"):
+                    record["status"] = "queued"
+                    self._save(record)
+                    if self.auto is not None and record.get("auto_apply") is not None:
+                        self.auto.resume(record["id"], record["auto_apply"])
+                    self._queue.put(record["id"])
+
+    def submit(self, job: dict, auto_apply: dict = None) -> dict:
+        # auto_apply is kept in the record for the auto applier, see AutoApplier.resume
+        job = check_job(job)
+        check_tweaks(job["tweaks"])
+        record = {
+            "id": uuid.uuid4().hex,
+            "job": job,
+            "status": "queued",
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "report": None,
+            "error": None,
+        }
+        if auto_apply is not None:
+            record["auto_apply"] = auto_apply
+        with self._lock:
+            self.jobs[record["id"]] = record
+            self._save(record)
+        self._queue.put(record["id"])
+        return dict(record)
+
+    def get(self, job_id: str) -> dict:
+        with self._lock:
+            record = self.jobs.get(job_id)
+            return dict(record) if record is not None else None
+
+    def list(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self.jobs.values()]
+
+    def devices(self) -> list:
+        return [
+            {
+                "serial": device.uuid,
+                "name": device.name,
+                "version": device.version,
+                "build": device.build,
+                "model": device.model,
+                "supported": device.supported(),
+            }
+            for device in self.registry.devices()
+        ]
+
+    def status(self) -> dict:
+        with self._lock:
+            states = [record["status"] for record in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "queued": states.count("queued"),
+            "running": states.count("running"),
+            "done": states.count("done"),
+            "failed": states.count("failed"),
+            "devices": len(self.registry),
+            "cache_bytes": self.cache.size(),
+        }
+
+    def _update(self, record: dict, **changes):
+        with self._lock:
+            record.update(changes)
+            self._save(record)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            with self._lock:
+                record = self.jobs.get(job_id)
+            if record is None or record["status"] != "queued":
+                continue
+            self._run(record)
+
+    def _run(self, record: dict):
+        job = record["job"]
+        devices = [device for device in self.registry.devices() if job["serials"] is None or device.uuid in job["serials"]]
+        attached = {device.uuid for device in devices}
+        errors = {serial: "not connected" for serial in job["serials"] or [] if serial not in attached}
+        # two jobs never restore to the same device at once, this one waits for the jobs that have its devices
+        with self._idle:
+            self._idle.wait_for(lambda: not attached & self._busy)
+            self._busy |= attached
+        try:
+            self._update(record, status="running", started=time.time())
+            if not devices and not errors:
+                self._update(record, status="failed", finished=time.time(), report={}, error="No devices attached")
+                return
+            try:
+                # cached backups are staged once for every job with the same tweaks
+                report = apply_job(job, devices, errors, cache=self.cache)
+            except Exception as e:
+                self._update(record, status="failed", finished=time.time(), error=str(e))
+            else:
+                failed = [f"{serial}: {entry.get('error', entry['status'])}" for serial, entry in report.items() if entry["status"] in ("error", "unsupported")]
+                self._update(record, status="failed" if failed else "done", finished=time.time(), report=report, error="; ".join(failed) or None)
+        finally:
+            with self._idle:
+                self._busy -= attached
+                self._idle.notify_all()
+            self._finished(record)
+
+    def _finished(self, record: dict):
+        if self.auto is not None:
+            self.auto.job_finished(record["id"], record["status"] == "done", record["error"])
+
+    def _attached(self, device):
+        print(f"Attached {device.name} ({device.uuid})", file=sys.stderr)
+        if self.auto is not None:
+            self.auto.device_attached(device)
+
+    def _listen(self):
+        listener = HotplugListener(
+            self.registry,
+            on_attached=self._attached,
+            on_detached=lambda serial: print(f"Detached {serial}", file=sys.stderr),
+            on_error=lambda error: print(error, file=sys.stderr)
+        )
+        # on the pool's loop, where the jobs find the sessions of its handshakes
+        self._listener = lockdown_pool.submit(listener.run())
+        try:
+            self._listener.result()
+        except CancelledError:
+            pass
+        except Exception as e:
+            print(f"Device listener stopped: {e}", file=sys.stderr)
+
+class _Handler(BaseHTTPRequestHandler):
+    def address_string(self) -> str:
+        # unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send(self, code: int, body):
+        data = json.dumps(body, indent=1).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        station = self.server.station
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["jobs"]:
+            self._send(200, station.list())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            record = station.get(parts[1])
+            if record is None:
+                self._send(404, {"error": "no such job"})
+            else:
+                self._send(200, record)
+        elif parts == ["devices"]:
+            self._send(200, station.devices())
+        elif parts == ["status"]:
+            self._send(200, station.status())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            record = self.server.station.submit(json.loads(self.rfile.read(length) or b"{}"))
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+            return
+        self._send(202, record)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(station: Station, host: str = "127.0.0.1", port: int = 8765, socket_path: str = None):
+    if socket_path is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    server.station = station
+    station.start()
+    print(f"Listening on {socket_path or f'http://{host}:{port}'}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        station.stop()
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run QuietDaemon as a station daemon with an HTTP job API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="serve on this unix socket instead of localhost")
+    parser.add_argument("--workers", type=int, default=2, help="jobs that run at the same time")
+    parser.add_argument("--state-dir", type=Path, help="where job records are kept")
+    parser.add_argument("--profiles", type=Path, help="apply these tweak profiles to every supported device that attaches")
+    args = parser.parse_args(argv)
+
+    profiles = None
+    if args.profiles is not None:
+        try:
+            profiles = ProfileStore.load(args.profiles)
+        except (OSError, ValueError) as e:
+            print(f"Invalid profiles file {args.profiles}: {e}", file=sys.stderr)
+            return 2
+
+    # progress messages of the restores go to stderr along with the daemon's own
+    with contextlib.redirect_stdout(sys.stderr):
+        serve(Station(args.state_dir, args.workers, profiles=profiles), args.host, args.port, args.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from Sparserestore.cache import default_cache_root
+
+from .constants import Device
+
+# a cached identity is trusted for this many seconds, after that the device is queried in full again
+FINGERPRINT_TTL = 7 * 24 * 60 * 60
+
+def default_fingerprint_path() -> Path:
+	return default_cache_root().parent / "devices.json"
+
+class FingerprintCache:
+	# identity of every device seen before, keyed by serial and kept in a JSON file so a known device can be
+	# shown before its lockdown query is done; an entry is replaced when the build changes, whether the device is
+	# supported follows from its version and model like for any other Device
+	# the file is only read on first use, so creating the cache touches nothing on disk
+	def __init__(self, path: Path = None, ttl: float = FINGERPRINT_TTL):
+		self._path = Path(path) if path is not None else None
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._loaded = None
+
+	@property
+	def path(self) -> Path:
+		if self._path is None:
+			self._path = default_fingerprint_path()
+		return self._path
+
+	@property
+	def _entries(self) -> dict:
+		# called with the lock held
+		if self._loaded is None:
+			try:
+				entries = json.loads(self.path.read_text())
+			except (OSError, ValueError):
+				entries = {}
+			self._loaded = entries if isinstance(entries, dict) else {}
+		return self._loaded
+
+	def _save(self):
+		# written next to the file and renamed into place so a crash never leaves half of it behind
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		temp = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}")
+		temp.write_text(json.dumps(self._entries, indent=1, sort_keys=True))
+		os.replace(temp, self.path)
+
+	def _entry(self, serial: str) -> Optional[dict]:
+		entry = self._entries.get(serial)
+		if entry is None or time.time() - entry.get('seen', 0) > self.ttl:
+			return None
+		return entry
+
+	def get(self, serial: str) -> Optional[Device]:
+		# the cached Device has no lockdown session, take one from the pool when it is needed
+		with self._lock:
+			entry = self._entry(serial)
+			if entry is None:
+				return None
+			return Device(
+				uuid=serial,
+				name=entry['name'],
+				version=entry['version'],
+				build=entry['build'],
+				model=entry['model'],
+				locale=entry['locale'],
+				ld=None
+			)
+
+	def put(self, device: Device):
+		with self._lock:
+			self._entries[device.uuid] = {
+				'name': device.name,
+				'version': device.version,
+				'build': device.build,
+				'model': device.model,
+				'locale': device.locale,
+				'seen': time.time(),
+			}
+			self._save()
+
+	def invalidate(self, serial: str):
+		with self._lock:
+			if self._entries.pop(serial, None) is not None:
+				self._save()
+
+	def clear(self):
+		with self._lock:
+			self._loaded = {}
+			self._save()
+
+	def __contains__(self, serial: str) -> bool:
+		with self._lock:
+			return self._entry(serial) is not None
+
+# the cache the app shares between its workers
+fingerprint_cache = FingerprintCache()
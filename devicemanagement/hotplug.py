@@ -0,0 +1,237 @@
+import asyncio
+import threading
+from typing import Callable, Optional
+
+from pymobiledevice3 import usbmux
+
+from .constants import Device
+from .fingerprints import FingerprintCache, fingerprint_cache
+from .lockdown_pool import LockdownPool, lockdown_pool
+
+# seconds a lockdown handshake may take before the device is skipped
+HANDSHAKE_TIMEOUT = 10
+# seconds a rebooting device may take to come back and accept lockdown
+READY_TIMEOUT = 300
+# retry delays of the lockdown handshake once a rebooted device is attached again
+READY_BACKOFF_START = 0.25
+READY_BACKOFF_MAX = 8
+# retry delays of the usbmux listen connection after usbmuxd dropped it
+RECONNECT_BACKOFF_START = 0.5
+RECONNECT_BACKOFF_MAX = 30
+
+async def connect_device(serial: str, pool: LockdownPool = lockdown_pool, fingerprints: FingerprintCache = fingerprint_cache) -> Device:
+	ld = await pool.get(serial)
+	# the handshake already read every value, a known device whose build is unchanged is reused as it is
+	vals = ld.all_values
+	known = fingerprints.get(serial)
+	if known is not None and vals.get('BuildVersion') == known.build:
+		# the name may have been changed on the device, and the entry counts as seen again
+		known.name = vals.get('DeviceName', known.name)
+		known.ld = ld
+		fingerprints.put(known)
+		return known
+	locale = vals.get('Locale', 'en')
+	device = Device(
+		uuid=serial,
+		name=vals['DeviceName'],
+		version=vals['ProductVersion'],
+		build=vals['BuildVersion'],
+		model=vals['ProductType'],
+		locale=locale,
+		ld=ld
+	)
+	fingerprints.put(device)
+	return device
+
+async def wait_until_ready(serial: str, timeout: float = READY_TIMEOUT, pool: LockdownPool = lockdown_pool) -> float:
+	# waits for a rebooting device to come back and accept lockdown again, returns how long that took;
+	# usbmuxd gives a device a new id whenever it attaches, so an attach of serial under an id that was not
+	# there when the wait began means it has been through its reboot, however early the reboot happened
+	loop = asyncio.get_running_loop()
+	start = loop.time()
+	deadline = start + timeout
+
+	def remaining() -> float:
+		left = deadline - loop.time()
+		if left <= 0:
+			raise TimeoutError(f"{serial} was not ready again after {timeout}s")
+		return left
+
+	async def next_update():
+		left = remaining()
+		try:
+			await asyncio.wait_for(mux.receive_device_state_update(), left)
+		except asyncio.TimeoutError:
+			remaining()
+			raise
+
+	known_ids = {device.devid for device in await usbmux.list_devices() if device.serial == serial}
+	mux = await usbmux.create_mux()
+	try:
+		await mux.listen()
+		# every attach and detach updates mux.devices, the devices that are attached right now
+		while not any(
+			device.is_usb and device.serial == serial and device.devid not in known_ids
+			for device in mux.devices
+		):
+			await next_update()
+	finally:
+		await mux.close()
+
+	# lockdown only answers once the device has booted far enough, retry with backoff until it does
+	pool.invalidate(serial)
+	delay = READY_BACKOFF_START
+	while True:
+		left = remaining()
+		try:
+			await asyncio.wait_for(pool.get(serial), left)
+			return loop.time() - start
+		except Exception:
+			# remaining() gives up once the deadline has passed
+			await asyncio.sleep(min(delay, remaining()))
+			delay = min(delay * 2, READY_BACKOFF_MAX)
+
+class DeviceRegistry:
+	# the devices that are attached right now, keyed by serial; safe to share between threads
+	def __init__(self):
+		self._devices = {}
+		self._lock = threading.Lock()
+
+	def add(self, device: Device) -> bool:
+		# returns whether the serial is new
+		with self._lock:
+			is_new = device.uuid not in self._devices
+			self._devices[device.uuid] = device
+			return is_new
+
+	def remove(self, serial: str) -> Optional[Device]:
+		with self._lock:
+			return self._devices.pop(serial, None)
+
+	def replace(self, devices: list):
+		with self._lock:
+			self._devices = {device.uuid: device for device in devices}
+
+	def get(self, serial: str) -> Optional[Device]:
+		with self._lock:
+			return self._devices.get(serial)
+
+	def devices(self) -> list:
+		with self._lock:
+			return list(self._devices.values())
+
+	def __contains__(self, serial: str) -> bool:
+		with self._lock:
+			return serial in self._devices
+
+	def __len__(self) -> int:
+		with self._lock:
+			return len(self._devices)
+
+class HotplugListener:
+	# follows the usbmux attach/detach stream and keeps a DeviceRegistry up to date
+	# usbmuxd reports every device that is already connected when listening starts, after that only
+	# newly attached serials get a lockdown handshake; a device in the fingerprint cache is reported
+	# right away and again once its handshake has confirmed it; when usbmuxd drops the connection (a restart of
+	# usbmuxd, a sleeping host) the listener reconnects with backoff and resyncs the registry
+	def __init__(
+		self,
+		registry: DeviceRegistry,
+		on_attached: Callable[[Device], None] = None,
+		on_detached: Callable[[str], None] = None,
+		on_error: Callable[[str], None] = None,
+		timeout: float = HANDSHAKE_TIMEOUT,
+		fingerprints: FingerprintCache = fingerprint_cache
+	):
+		self.registry = registry
+		self.fingerprints = fingerprints
+		self.on_attached = on_attached
+		self.on_detached = on_detached
+		self.on_error = on_error
+		self.timeout = timeout
+		# usbmux device ids to serials of the devices seen attached so far
+		self._serials = {}
+		self._handshakes = {}
+
+	async def run(self):
+		delay = RECONNECT_BACKOFF_START
+		try:
+			while True:
+				try:
+					mux = await usbmux.create_mux()
+				except Exception as e:
+					error = e
+				else:
+					try:
+						await mux.listen()
+						# listening from here on, the snapshot taken now is what is attached; a device that goes
+						# away before its attach is reported is still detached by the stream
+						mux.devices = list(await usbmux.list_devices())
+						self.update(mux.devices)
+						delay = RECONNECT_BACKOFF_START
+						while True:
+							await mux.receive_device_state_update()
+							self.update(mux.devices)
+					except Exception as e:
+						error = e
+					finally:
+						await mux.close()
+				if self.on_error:
+					self.on_error(f"Lost the usbmux connection ({error}), reconnecting in {delay}s")
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+		finally:
+			for handshake in list(self._handshakes.values()):
+				handshake.cancel()
+
+	def update(self, devices: list):
+		# devices is what usbmuxd has attached right now (MuxConnection.devices), compared by id with what was seen before
+		attached = {device.devid: device.serial for device in devices if device.is_usb}
+		for devid in self._serials.keys() - attached.keys():
+			self._detached(devid)
+		for devid, serial in attached.items():
+			if devid not in self._serials:
+				self._attached(devid, serial)
+
+	def _attached(self, devid: int, serial: str):
+		self._serials[devid] = serial
+		if serial in self.registry or serial in self._handshakes:
+			return
+		known = self.fingerprints.get(serial)
+		if known is not None:
+			self.registry.add(known)
+			if self.on_attached:
+				self.on_attached(known)
+		self._handshakes[serial] = asyncio.ensure_future(self._attach(serial))
+
+	def _detached(self, devid: int):
+		serial = self._serials.pop(devid)
+		if serial in self._serials.values():
+			# still attached under another id
+			return
+		handshake = self._handshakes.pop(serial, None)
+		if handshake is not None:
+			handshake.cancel()
+		lockdown_pool.invalidate(serial)
+		if self.registry.remove(serial) is not None and self.on_detached:
+			self.on_detached(serial)
+
+	async def _attach(self, serial: str):
+		task = asyncio.current_task()
+		try:
+			device = await asyncio.wait_for(connect_device(serial, fingerprints=self.fingerprints), self.timeout)
+		except Exception as e:
+			if self.on_error:
+				reason = "timed out" if isinstance(e, asyncio.TimeoutError) else e
+				self.on_error(f"Error connecting to device {serial}: {reason}")
+			# a device that was shown from the cache is not usable after all
+			if self.registry.remove(serial) is not None and self.on_detached:
+				self.on_detached(serial)
+		else:
+			self.registry.add(device)
+			if self.on_attached:
+				self.on_attached(device)
+		finally:
+			# a detach and reattach may already have started a newer handshake
+			if self._handshakes.get(serial) is task:
+				del self._handshakes[serial]
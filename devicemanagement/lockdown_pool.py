@@ -0,0 +1,193 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from pymobiledevice3.lockdown import LockdownClient, create_using_usbmux
+
+# sessions that were not used for this many seconds are closed
+IDLE_TIMEOUT = 300
+# seconds between two looks for idle sessions
+EVICT_INTERVAL = 30
+# a session checked within this many seconds is trusted without asking the device again
+HEALTH_INTERVAL = 5
+# seconds the health check may take before the session counts as dead
+HEALTH_TIMEOUT = 3
+
+class _Session:
+	def __init__(self, ld: LockdownClient):
+		self.ld = ld
+		self.last_used = time.monotonic()
+		self.last_checked = self.last_used
+
+async def _close(ld: LockdownClient):
+	try:
+		await ld.close()
+	except Exception:
+		pass
+
+class LockdownPool:
+	# one lockdown session per serial, shared by discovery, apply, reboot and the wait for the device to come back
+	# so pairing and the handshake are only paid once per device cycle
+	# a client lives on the asyncio streams of the loop that connected it, so the pool owns the one event loop
+	# every device coroutine runs on, in a thread of its own; workers hand their coroutines to run() or submit()
+	# and get() may only be awaited on that loop
+	def __init__(self, idle_timeout: float = IDLE_TIMEOUT, health_interval: float = HEALTH_INTERVAL, evict_interval: float = EVICT_INTERVAL):
+		self.idle_timeout = idle_timeout
+		self.health_interval = health_interval
+		self.evict_interval = evict_interval
+		# serial -> _Session, and serial -> the task that is connecting it; only touched on the pool's loop
+		self._sessions = {}
+		self._connecting = {}
+		self._lock = threading.Lock()
+		self._loop = None
+		self._thread = None
+
+	@property
+	def loop(self) -> asyncio.AbstractEventLoop:
+		# started on first use
+		with self._lock:
+			if self._loop is None:
+				self._loop = asyncio.new_event_loop()
+				self._thread = threading.Thread(target=self._serve, args=(self._loop,), name="lockdown-pool", daemon=True)
+				self._thread.start()
+			return self._loop
+
+	def _serve(self, loop: asyncio.AbstractEventLoop):
+		asyncio.set_event_loop(loop)
+		loop.call_soon(self._schedule_eviction)
+		try:
+			loop.run_forever()
+		finally:
+			loop.close()
+
+	def _schedule_eviction(self):
+		self.evict_idle()
+		asyncio.get_running_loop().call_later(self.evict_interval, self._schedule_eviction)
+
+	def submit(self, coro) -> concurrent.futures.Future:
+		# runs coro on the pool's loop; cancelling the returned future cancels it
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+	def run(self, coro):
+		# runs coro on the pool's loop and waits for its result, for worker threads
+		if threading.current_thread() is self._thread:
+			raise RuntimeError("LockdownPool.run() can not be called from the pool's own loop, await the coroutine")
+		return self.submit(coro).result()
+
+	def _check_loop(self):
+		if asyncio.get_running_loop() is not self._loop:
+			raise RuntimeError("Lockdown sessions can only be used on the pool's loop, see LockdownPool.run()")
+
+	async def get(self, serial: str) -> LockdownClient:
+		# returns a live session, reconnecting when the old one is gone (after a reboot or a replug)
+		self._check_loop()
+		session = self._sessions.get(serial)
+		if session is not None:
+			if await self._healthy(session):
+				session.last_used = time.monotonic()
+				return session.ld
+			await self._drop(serial, session)
+
+		# tasks asking for the same serial at once share one handshake
+		connecting = self._connecting.get(serial)
+		if connecting is None:
+			connecting = self._connecting[serial] = asyncio.ensure_future(create_using_usbmux(serial=serial))
+			connecting.add_done_callback(lambda task: self._connected(serial, task))
+		return await asyncio.shield(connecting)
+
+	def _connected(self, serial: str, task: asyncio.Task):
+		if task.cancelled() or task.exception() is not None:
+			if self._connecting.get(serial) is task:
+				del self._connecting[serial]
+		elif self._connecting.get(serial) is task:
+			del self._connecting[serial]
+			self._sessions[serial] = _Session(task.result())
+		else:
+			# invalidated while it was connecting
+			asyncio.get_running_loop().create_task(_close(task.result()))
+
+	async def _healthy(self, session: _Session) -> bool:
+		now = time.monotonic()
+		if now - session.last_checked < self.health_interval:
+			return True
+		try:
+			await asyncio.wait_for(session.ld.get_value(key='ProductVersion'), HEALTH_TIMEOUT)
+		except Exception:
+			return False
+		session.last_checked = time.monotonic()
+		return True
+
+	async def _drop(self, serial: str, session: _Session):
+		if self._sessions.get(serial) is session:
+			del self._sessions[serial]
+		await _close(session.ld)
+
+	def _call(self, callback, *args):
+		# runs callback on the pool's loop, right away when already on it; nothing to do before the loop exists
+		loop = self._loop
+		if loop is None:
+			return
+		try:
+			if asyncio.get_running_loop() is loop:
+				callback(*args)
+				return
+		except RuntimeError:
+			pass
+		try:
+			loop.call_soon_threadsafe(callback, *args)
+		except RuntimeError:
+			# closed in the meantime
+			pass
+
+	def _close_sessions(self, predicate):
+		for serial, session in list(self._sessions.items()):
+			if predicate(serial, session):
+				del self._sessions[serial]
+				asyncio.get_running_loop().create_task(_close(session.ld))
+
+	def _invalidate(self, serial: str):
+		# a handshake that is still running belongs to the device as it was, its session is not kept either
+		self._connecting.pop(serial, None)
+		self._close_sessions(lambda key, session: key == serial)
+
+	def invalidate(self, serial: str):
+		# drops the session of serial, after a reboot or a detach it does not work any more; safe from any thread
+		self._call(self._invalidate, serial)
+
+	def evict_idle(self):
+		now = time.monotonic()
+		self._call(self._close_sessions, lambda key, session: now - session.last_used > self.idle_timeout)
+
+	def close(self):
+		# closes every session and stops the loop, called when the app exits
+		with self._lock:
+			loop, thread = self._loop, self._thread
+			self._loop = self._thread = None
+		if loop is None:
+			return
+
+		async def shutdown():
+			# what is still running (a hotplug listener, closes started by invalidate) goes first
+			tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			sessions, self._sessions = list(self._sessions.values()), {}
+			await asyncio.gather(*(_close(session.ld) for session in sessions))
+			loop.stop()
+		try:
+			asyncio.run_coroutine_threadsafe(shutdown(), loop)
+		except RuntimeError:
+			return
+		if thread is not threading.current_thread():
+			thread.join()
+
+	def __contains__(self, serial: str) -> bool:
+		return serial in self._sessions
+
+	def __len__(self) -> int:
+		return len(self._sessions)
+
+# the pool the app shares between its workers
+lockdown_pool = LockdownPool()
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Optional
+
+from .constants import Device
+from .tweaks import check_tweaks
+
+# settings a profile may have, with their defaults
+PROFILE_DEFAULTS = {
+	"tweaks": [],
+	"skip_setup": True,
+	"reboot": True,
+	"wait_ready": False,
+}
+
+def _write_json(path: Path, value):
+	# written next to the file and renamed into place so a crash never leaves half of it behind
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+	temp.write_text(json.dumps(value, indent=1, sort_keys=True))
+	os.replace(temp, path)
+
+class ProfileStore:
+	# tweak profiles and which device gets which, read from a JSON file like
+	#   {"profiles": {"quiet": {"tweaks": ["thermalmonitord"]}}, "devices": {"<serial>": "quiet"}, "default": "quiet"}
+	# a device without an entry gets the default profile, or nothing when there is no default
+	def __init__(self, profiles: dict, devices: dict = None, default: Optional[str] = None):
+		self.profiles = {}
+		for name, profile in profiles.items():
+			unknown = profile.keys() - PROFILE_DEFAULTS.keys()
+			if unknown:
+				raise ValueError(f"Unknown settings in profile {name}: {', '.join(sorted(unknown))}")
+			profile = {**PROFILE_DEFAULTS, **profile}
+			check_tweaks(profile["tweaks"])
+			self.profiles[name] = profile
+		self.devices = dict(devices or {})
+		self.default = default
+		for serial, name in [*self.devices.items(), ("default", default)]:
+			if name is not None and name not in self.profiles:
+				raise ValueError(f"{serial} uses the unknown profile {name}")
+
+	@classmethod
+	def load(cls, path: Path) -> "ProfileStore":
+		data = json.loads(Path(path).read_text())
+		return cls(data.get("profiles", {}), data.get("devices"), data.get("default"))
+
+	def profile_for(self, serial: str) -> Optional[tuple[str, dict]]:
+		name = self.devices.get(serial, self.default)
+		return None if name is None else (name, self.profiles[name])
+
+def profile_digest(profile: dict) -> str:
+	return sha256(json.dumps(profile, sort_keys=True).encode("utf-8")).hexdigest()
+
+class AppliedLedger:
+	# the profile each device was last configured with, together with the build it was running;
+	# a device is only configured again when either of them changed
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self._lock = threading.Lock()
+		try:
+			self._entries = json.loads(self.path.read_text())
+		except (OSError, ValueError):
+			self._entries = {}
+
+	def is_applied(self, device: Device, digest: str) -> bool:
+		with self._lock:
+			entry = self._entries.get(device.uuid)
+			return entry is not None and entry["digest"] == digest and entry["build"] == device.build
+
+	def record(self, serial: str, build: str, digest: str):
+		with self._lock:
+			self._entries[serial] = {"digest": digest, "build": build, "applied": time.time()}
+			_write_json(self.path, self._entries)
+
+class AutoApplier:
+	# applies the profile of every supported device that attaches, through submit (which queues a job
+	# the way cli.py job files are written and returns its id, and keeps the second argument with it so a
+	# job queued again after a restart can be handed back to resume); job_finished has to be called with
+	# the outcome of those jobs; every decision is appended to the log as a JSON line
+	def __init__(self, store: ProfileStore, ledger: AppliedLedger, submit: Callable[[dict, dict], str], log_path: Path):
+		self.store = store
+		self.ledger = ledger
+		self.submit = submit
+		self.log_path = Path(log_path)
+		self._lock = threading.Lock()
+		self._log_lock = threading.Lock()
+		# job ids to the serial, build, profile name and digest they configure, and the serials that have one
+		self._jobs = {}
+		self._pending = set()
+
+	def log(self, serial: str, event: str, **details):
+		entry = {"time": time.time(), "serial": serial, "event": event, **details}
+		line = json.dumps(entry)
+		print(f"Auto apply {serial}: {event}")
+		with self._log_lock:
+			self.log_path.parent.mkdir(parents=True, exist_ok=True)
+			with open(self.log_path, "a") as log:
+				log.write(line + "\n")
+
+	def device_attached(self, device: Device):
+		# devices shown from the fingerprint cache are reported again once their handshake is done
+		if device.ld is None:
+			return
+		choice = self.store.profile_for(device.uuid)
+		if choice is None:
+			return
+		name, profile = choice
+		digest = profile_digest(profile)
+		if not device.supported():
+			self.log(device.uuid, "unsupported", profile=name, version=device.version, build=device.build)
+			return
+		if self.ledger.is_applied(device, digest):
+			self.log(device.uuid, "already configured", profile=name)
+			return
+		# submitted under the lock so job_finished can not see the job before it is known here
+		with self._lock:
+			if device.uuid in self._pending:
+				return
+			auto_apply = {"serial": device.uuid, "build": device.build, "profile": name, "digest": digest}
+			try:
+				job_id = self.submit({**profile, "serials": [device.uuid]}, auto_apply)
+			except Exception as e:
+				job_id, error = None, str(e)
+			else:
+				self._pending.add(device.uuid)
+				self._jobs[job_id] = (device.uuid, device.build, name, digest)
+		if job_id is None:
+			self.log(device.uuid, "failed", profile=name, error=error)
+		else:
+			self.log(device.uuid, "queued", profile=name, job=job_id)
+
+	def resume(self, job_id: str, auto_apply: dict):
+		# a job submitted before a restart, auto_apply is what was handed to submit with it
+		serial = auto_apply["serial"]
+		with self._lock:
+			self._pending.add(serial)
+			self._jobs[job_id] = (serial, auto_apply["build"], auto_apply["profile"], auto_apply["digest"])
+		self.log(serial, "queued again", profile=auto_apply["profile"], job=job_id)
+
+	def job_finished(self, job_id: str, ok: bool, error: Optional[str] = None):
+		with self._lock:
+			entry = self._jobs.pop(job_id, None)
+			if entry is None:
+				return
+			serial, build, name, digest = entry
+			self._pending.discard(serial)
+		if ok:
+			self.ledger.record(serial, build, digest)
+			self.log(serial, "applied", profile=name, job=job_id)
+		else:
+			self.log(serial, "failed", profile=name, job=job_id, error=error)
@@ -0,0 +1,60 @@
+# the tweak names and the launchd services behind them, kept free of device imports so a job file can be
+# checked without loading pymobiledevice3
+
+REPORT_CRASH_SERVICES = [
+	"com.apple.ReportCrash",
+	"com.apple.ReportCrash.DirectoryService",
+	"com.apple.ReportCrash.Jetsam",
+	"com.apple.ReportCrash.SafetyNet",
+	"com.apple.ReportCrash.StackShot",
+	"com.apple.ReportMemoryException",
+	"com.apple.ReportSystemMemory",
+	"com.apple.OTACrashCopier",
+	"com.apple.ProxiedCrashCopier",
+	"com.apple.ProxiedCrashCopier.ProxyingDevice",
+	"com.apple.analyticsd",
+	"com.apple.awdd",
+	"com.apple.wifianalyticsd",
+	"com.apple.aslmanager",
+	"com.apple.coresymbolicationd",
+	"com.apple.crash_mover",
+	"com.apple.crashreportcopymobile",
+	"com.apple.CrashHousekeeping",
+	"com.apple.DumpBasebandCrash",
+	"com.apple.DumpPanic",
+	"com.apple.logd",
+	"com.apple.logd.admin",
+	"com.apple.logd.events",
+	"com.apple.logd.watchdog",
+	"com.apple.logd_helper",
+	"com.apple.logd_reporter",
+	"com.apple.logd_reporter.report_statistics",
+	"com.apple.system.logger",
+	"com.apple.hangreporter",
+	"com.apple.hangtracerd",
+	"com.apple.spindump",
+	"com.apple.tailspind",
+	"com.apple.rtcreportingd",
+	"com.apple.syslogd",
+	"com.apple.syslog_relay",
+	"com.apple.signpost.signpost_reporter",
+	"com.apple.pluginkit.pkreporter"
+]
+
+# the tweaks that can be chosen (in the GUI and in job files) and the services each one disables
+TWEAKS = {
+	"thermalmonitord": ["com.apple.thermalmonitord"],
+	"ota": ["com.apple.mobile.softwareupdated", "com.apple.OTATaskingAgent", "com.apple.softwareupdateservicesd"],
+	"usage_tracking_agent": ["com.apple.UsageTrackingAgent"],
+	"gamed": ["com.apple.gamed"],
+	"screentime": ["com.apple.ScreenTimeAgent"],
+	"reportcrash": REPORT_CRASH_SERVICES,
+	"tipsd": ["com.apple.tipsd"],
+}
+
+def check_tweaks(tweaks) -> set:
+	tweaks = set(tweaks)
+	unknown = tweaks - TWEAKS.keys()
+	if unknown:
+		raise ValueError(f"Unknown tweaks: {', '.join(sorted(unknown))} (known: {', '.join(TWEAKS)})")
+	return tweaks
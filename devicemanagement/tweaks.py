@@ -0,0 +1,77 @@
+import plistlib
+
+from Sparserestore.restore import FileToRestore, restore_files
+
+from .lockdown_pool import LockdownPool, lockdown_pool
+from .tweak_services import REPORT_CRASH_SERVICES, TWEAKS, check_tweaks
+
+# services that are always in disabled.plist, whatever tweaks are chosen
+DEFAULT_DISABLED_PLIST = {
+	"com.apple.magicswitchd.companion": True,
+	"com.apple.security.otpaird": True,
+	"com.apple.dhcp6d": True,
+	"com.apple.bootpd": True,
+	"com.apple.ftp-proxy-embedded": False,
+	"com.apple.relevanced": True,
+}
+
+def disabled_plist(tweaks) -> bytes:
+	tweaks = check_tweaks(tweaks)
+	plist = DEFAULT_DISABLED_PLIST.copy()
+	for tweak, services in TWEAKS.items():
+		for service in services:
+			if tweak in tweaks:
+				plist[service] = True
+			else:
+				plist.pop(service, None)
+	return plistlib.dumps(plist, fmt=plistlib.FMT_XML)
+
+def skip_setup_files() -> list:
+	cloud_config_plist = {
+		"SkipSetup": ["WiFi", "Location", "Restore", "SIMSetup", "Android", "AppleID", "IntendedUser", "TOS", "Siri", "ScreenTime", "Diagnostics", "SoftwareUpdate", "Passcode", "Biometric", "Payment", "Zoom", "DisplayTone", "MessagingActivationUsingPhoneNumber", "HomeButtonSensitivity", "CloudStorage", "ScreenSaver", "TapToSetup", "Keyboard", "PreferredLanguage", "SpokenLanguage", "WatchMigration", "OnBoarding", "TVProviderSignIn", "TVHomeScreenSync", "Privacy", "TVRoom", "iMessageAndFaceTime", "AppStore", "Safety", "Multitasking", "ActionButton", "TermsOfAddress", "AccessibilityAppearance", "Welcome", "Appearance", "RestoreCompleted", "UpdateCompleted"],
+		"AllowPairing": True,
+		"ConfigurationWasApplied": True,
+		"CloudConfigurationUIComplete": True,
+		"ConfigurationSource": 0,
+		"PostSetupProfileWasInstalled": True,
+		"IsSupervised": False,
+	}
+	purplebuddy_plist = {
+		"SetupDone": True,
+		"SetupFinishedAllSteps": True,
+		"UserChoseLanguage": True
+	}
+	return [
+		FileToRestore(
+			contents=plistlib.dumps(cloud_config_plist),
+			restore_path="systemgroup.com.apple.configurationprofiles/Library/ConfigurationProfiles/CloudConfigurationDetails.plist",
+			domain="SysSharedContainerDomain-."
+		),
+		FileToRestore(
+			contents=plistlib.dumps(purplebuddy_plist),
+			restore_path="mobile/com.apple.purplebuddy.plist",
+			domain="ManagedPreferencesDomain"
+		),
+	]
+
+def tweak_files(tweaks, skip_setup: bool = True) -> list:
+	# everything that is restored to apply tweaks
+	files = [FileToRestore(
+		contents=disabled_plist(tweaks),
+		restore_path="com.apple.xpc.launchd/disabled.plist",
+		domain="DatabaseDomain",
+		owner=0,
+		group=0
+	)]
+	if skip_setup:
+		files.extend(skip_setup_files())
+	return files
+
+async def apply_tweaks(serial: str, tweaks, skip_setup: bool = True, reboot: bool = True, pool: LockdownPool = lockdown_pool):
+	files = tweak_files(tweaks, skip_setup)
+	# a session kept from discovery may be gone by now, the pool checks it and reconnects if needed
+	lockdown_client = await pool.get(serial)
+	await restore_files(files=files, reboot=reboot, lockdown_client=lockdown_client)
+	if reboot:
+		# the device is rebooting, its next session has to be a new one
+		pool.invalidate(serial)
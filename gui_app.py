@@ -1,7 +1,7 @@
 import platform
-import plistlib
 import traceback
 import asyncio
+from concurrent.futures import CancelledError
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtSvg import QSvgWidget
@@ -9,11 +9,11 @@ from PyQt5.QtCore import QLocale, QThread, pyqtSignal
 from PyQt5.QtGui import QPalette, QColor
 from pymobiledevice3 import usbmux
 from PyQt5.QtWidgets import QApplication
-from pymobiledevice3.lockdown import create_using_usbmux
 
 import resources_rc
-from Sparserestore.restore import restore_files, FileToRestore
-from devicemanagement.constants import Device
+from devicemanagement.hotplug import DeviceRegistry, HotplugListener, connect_device, wait_until_ready, HANDSHAKE_TIMEOUT
+from devicemanagement.lockdown_pool import lockdown_pool
+from devicemanagement.tweaks import apply_tweaks
 
 palette = QPalette()
 palette.setColor(QPalette.Window, QColor(45, 45, 48))
@@ -21,88 +21,134 @@ palette.setColor(QPalette.WindowText, QColor(255, 255, 255))
 
 
 class DeviceWorker(QThread):
-    device_ready = pyqtSignal(object)
+    # every device is emitted through device_found as soon as its handshake is done, devices_ready follows with all of them
+    device_found = pyqtSignal(object)
+    devices_ready = pyqtSignal(list)
     error = pyqtSignal(str)
 
+    HANDSHAKE_TIMEOUT = HANDSHAKE_TIMEOUT
+
+    def __init__(self):
+        super().__init__()
+        self._scan = None
+
     def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
         try:
-            device = loop.run_until_complete(self._get_device())
-            self.device_ready.emit(device)
+            # the handshakes stay in the pool for the apply and the hotplug listener
+            self._scan = lockdown_pool.submit(self._get_devices())
+            devices, errors = self._scan.result()
+            if errors and not devices:
+                self.error.emit("\n".join(errors))
+            else:
+                for error in errors:
+                    print(error)
+                self.devices_ready.emit(devices)
+        except CancelledError:
+            pass
         except Exception as e:
             self.error.emit(str(e))
-        finally:
-            loop.close()
 
-    async def _get_device(self):
+    def stop(self):
+        # cancels the handshakes on the pool's loop, the thread ends once they are gone
+        if self._scan is not None:
+            self._scan.cancel()
+        self.wait()
+
+    async def _try_connect(self, serial):
+        try:
+            return await asyncio.wait_for(connect_device(serial), self.HANDSHAKE_TIMEOUT), None
+        except asyncio.TimeoutError:
+            return None, f"Error connecting to device {serial}: timed out"
+        except Exception as e:
+            return None, f"Error connecting to device {serial}: {e}"
+
+    async def _get_devices(self):
+        # the handshakes run concurrently, so discovery takes as long as the slowest device
         connected_devices = await usbmux.list_devices()
-        for current_device in connected_devices:
-            if current_device.is_usb:
-                try:
-                    ld = await create_using_usbmux(serial=current_device.serial)
-                    vals = ld.all_values
-                    locale = vals.get('Locale', 'en')
-                    return Device(
-                        uuid=current_device.serial,
-                        name=vals['DeviceName'],
-                        version=vals['ProductVersion'],
-                        build=vals['BuildVersion'],
-                        model=vals['ProductType'],
-                        locale=locale,
-                        ld=ld
-                    )
-                except Exception as e:
-                    raise Exception(f"Error connecting to device {current_device.serial}: {e}")
-        return None
+        handshakes = [self._try_connect(current_device.serial) for current_device in connected_devices if current_device.is_usb]
+        devices = []
+        errors = []
+        for handshake in asyncio.as_completed(handshakes):
+            device, error = await handshake
+            if device:
+                devices.append(device)
+                self.device_found.emit(device)
+            else:
+                errors.append(error)
+        return devices, errors
+
+
+class HotplugWorker(QThread):
+    # runs a HotplugListener for as long as the app is open and reports every change to the registry
+    device_attached = pyqtSignal(object)
+    device_detached = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+        self._listener = None
+
+    def run(self):
+        listener = HotplugListener(
+            self.registry,
+            on_attached=self.device_attached.emit,
+            on_detached=self.device_detached.emit,
+            on_error=self.error.emit
+        )
+        # the listener runs on the pool's loop, so its handshakes leave sessions the other workers can use
+        self._listener = lockdown_pool.submit(listener.run())
+        try:
+            self._listener.result()
+        except CancelledError:
+            pass
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        self.wait()
 
 
 class ApplyWorker(QThread):
     finished = pyqtSignal(bool, str)
     progress = pyqtSignal(str)
 
-    def __init__(self, device, files_to_restore_func, skip_setup_func, language_pack, language):
+    def __init__(self, device, tweaks, skip_setup, language_pack, language, wait_ready=False):
         super().__init__()
         self.device = device
-        self.files_to_restore_func = files_to_restore_func
-        self.skip_setup_func = skip_setup_func
+        self.tweaks = tweaks
+        self.skip_setup = skip_setup
         self.language_pack = language_pack
         self.language = language
+        # with wait_ready, success is only reported once the device is back from its reboot
+        self.wait_ready = wait_ready
 
     def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(self._apply())
+            lockdown_pool.run(self._apply())
             self.finished.emit(True, self.language_pack[self.language]["success"])
         except Exception as e:
             self.finished.emit(False, str(e))
-        finally:
-            loop.close()
 
     async def _apply(self):
-        files_to_restore = []
         self.progress.emit(self.language_pack[self.language]["apply_changes"])
-        plist_data = self.files_to_restore_func()
-        files_to_restore.append(FileToRestore(
-            contents=plist_data,
-            restore_path="com.apple.xpc.launchd/disabled.plist",
-            domain="DatabaseDomain",
-            owner=0,
-            group=0
-        ))
-        self.skip_setup_func(files_to_restore)
-        # ✅ Correct usage: async context manager
-        async with restore_files(files=files_to_restore, reboot=True, lockdown_client=self.device.ld):
-            # The restore operation runs inside this block
-            pass
+        await apply_tweaks(self.device.uuid, self.tweaks, skip_setup=self.skip_setup, reboot=True)
+        if not self.wait_ready:
+            return
+        self.progress.emit(self.language_pack[self.language]["waiting_for_device"])
+        ready_seconds = await wait_until_ready(self.device.uuid)
+        print(f"{self.device.name} was ready again after {ready_seconds:.1f}s")
 
 
 class App(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
         self.device = None
+        self.registry = DeviceRegistry()
         self.device_worker = None
+        self.hotplug_worker = None
         self.apply_worker = None
 
         # Detect system language
@@ -133,6 +179,9 @@ class App(QtWidgets.QWidget):
                         "ios_version": "iOS",
                         "apply_changes": "Applying changes to disabled.plist...",
                         "applying_changes": "Applying changes...",
+                        "waiting_for_device": "Waiting for the device to restart...",
+                        "wait_ready": "Wait for the device to restart",
+                        "wait_ready_note": "Only reports success once the device is back from its restart and can be used again.",
                         "success": "Changes applied successfully!",
                         "error": "An error occurred while applying changes to disabled.plist:",
                         "error_connecting": "Error connecting to device",
@@ -168,6 +217,9 @@ class App(QtWidgets.QWidget):
                         "ios_version": "iOS",
                         "apply_changes": "正在应用更改到 disabled.plist...",
                         "applying_changes": "正在应用修改...",
+                        "waiting_for_device": "正在等待设备重启...",
+                        "wait_ready": "等待设备重启完成",
+                        "wait_ready_note": "仅在设备重启完成并可再次使用后才报告成功。",
                         "success": "更改已成功应用！",
                         "error": "应用更改时发生错误：",
                         "error_connecting": "连接设备时发生错误",
@@ -203,6 +255,9 @@ class App(QtWidgets.QWidget):
                         "ios_version": "iOS",
                         "apply_changes": "disabled.plist に変更を適用しています...",
                         "applying_changes": "変更を適用中...",
+                        "waiting_for_device": "デバイスの再起動を待っています...",
+                        "wait_ready": "デバイスの再起動を待つ",
+                        "wait_ready_note": "デバイスが再起動を終えて再び使用できるようになってから成功を報告します。",
                         "success": "変更が正常に適用されました！",
                         "error": "disabled.plist への変更の適用中にエラーが発生しました：",
                         "error_connecting": "デバイスへの接続中にエラーが発生しました",
@@ -232,7 +287,9 @@ class App(QtWidgets.QWidget):
         }
 
         self.init_ui()
-        self.get_device_info()
+        # no device until the listener reports the ones that are already connected, refresh rescans on demand
+        self.update_device_info()
+        self.start_hotplug()
 
     def set_font(self):
         if platform.system() == "Windows":
@@ -290,6 +347,10 @@ class App(QtWidgets.QWidget):
         self.disable_tipsd_checkbox.setToolTip(self.language_pack[self.language]["menu_notes"][6])
         self.layout.addWidget(self.disable_tipsd_checkbox)
 
+        self.wait_ready_checkbox = QtWidgets.QCheckBox(self.language_pack[self.language]["wait_ready"])
+        self.wait_ready_checkbox.setToolTip(self.language_pack[self.language]["wait_ready_note"])
+        self.layout.addWidget(self.wait_ready_checkbox)
+
         self.apply_button = QtWidgets.QPushButton(self.language_pack[self.language]["menu_options"][7])
         self.apply_button.setStyleSheet("color: white")
         self.apply_button.clicked.connect(self.apply_changes)
@@ -323,22 +384,54 @@ class App(QtWidgets.QWidget):
         self.device_info.setText(self.language_pack[self.language]["apply_changes"])
 
         if self.device_worker and self.device_worker.isRunning():
-            self.device_worker.terminate()
-            self.device_worker.wait()
+            self.device_worker.stop()
 
         self.device_worker = DeviceWorker()
-        self.device_worker.device_ready.connect(self.on_device_ready)
+        self.device_worker.device_found.connect(self.on_device_attached)
+        self.device_worker.devices_ready.connect(self.on_devices_ready)
         self.device_worker.error.connect(self.on_device_error)
         self.device_worker.start()
 
-    def on_device_ready(self, device):
+    def start_hotplug(self):
+        self.hotplug_worker = HotplugWorker(self.registry)
+        self.hotplug_worker.device_attached.connect(self.on_device_attached)
+        self.hotplug_worker.device_detached.connect(self.on_device_detached)
+        self.hotplug_worker.error.connect(lambda error_msg: print(error_msg))
+        self.hotplug_worker.start()
+
+    @property
+    def devices(self):
+        return self.registry.devices()
+
+    def on_device_attached(self, device):
+        self.registry.add(device)
+        # the first device that is ready can be used right away, a known one is reported again once confirmed
+        if self.device is None or self.device.uuid == device.uuid:
+            self.select_device(device)
+
+    def on_device_detached(self, serial):
+        if self.device and self.device.uuid == serial:
+            devices = self.devices
+            self.select_device(devices[0] if devices else None)
+
+    def on_devices_ready(self, devices):
+        # a full rescan also drops devices whose detach was missed
+        self.registry.replace(devices)
+        if self.device is None or self.registry.get(self.device.uuid) is None:
+            self.device = devices[0] if devices else None
+        self.select_device(self.device)
+
+    def select_device(self, device):
         self.device = device
+        self.update_device_info()
         if device:
-            self.update_device_info()
             self.disable_controls(False)
-        else:
-            self.device_info.setText(self.language_pack[self.language]["connect_prompt"])
-            self.disable_controls(True)
+
+    def closeEvent(self, event):
+        if self.hotplug_worker:
+            self.hotplug_worker.stop()
+        lockdown_pool.close()
+        super().closeEvent(event)
 
     def on_device_error(self, error_msg):
         self.device = None
@@ -353,6 +446,7 @@ class App(QtWidgets.QWidget):
         self.disable_screentime_checkbox.setEnabled(not disable)
         self.disable_reportcrash_checkbox.setEnabled(not disable)
         self.disable_tipsd_checkbox.setEnabled(not disable)
+        self.wait_ready_checkbox.setEnabled(not disable)
         self.apply_button.setEnabled(not disable)
 
     def update_device_info(self):
@@ -362,83 +456,17 @@ class App(QtWidgets.QWidget):
             self.device_info.setText(self.language_pack[self.language]["connect_prompt"])
             self.disable_controls(True)
 
-    def modify_disabled_plist(self):
-        default_disabled_plist = {
-            "com.apple.magicswitchd.companion": True,
-            "com.apple.security.otpaird": True,
-            "com.apple.dhcp6d": True,
-            "com.apple.bootpd": True,
-            "com.apple.ftp-proxy-embedded": False,
-            "com.apple.relevanced": True,
+    def selected_tweaks(self):
+        checkboxes = {
+            "thermalmonitord": self.thermalmonitord_checkbox,
+            "ota": self.disable_ota_checkbox,
+            "usage_tracking_agent": self.disable_usage_tracking_checkbox,
+            "gamed": self.disable_gamed_checkbox,
+            "screentime": self.disable_screentime_checkbox,
+            "reportcrash": self.disable_reportcrash_checkbox,
+            "tipsd": self.disable_tipsd_checkbox,
         }
-
-        plist = default_disabled_plist.copy()
-
-        checkbox_settings = {
-                "com.apple.thermalmonitord": self.thermalmonitord_checkbox.isChecked(),
-                "com.apple.mobile.softwareupdated": self.disable_ota_checkbox.isChecked(),
-                "com.apple.OTATaskingAgent": self.disable_ota_checkbox.isChecked(),
-                "com.apple.softwareupdateservicesd": self.disable_ota_checkbox.isChecked(),
-                "com.apple.UsageTrackingAgent": self.disable_usage_tracking_checkbox.isChecked(),
-                "com.apple.gamed": self.disable_gamed_checkbox.isChecked(),
-                "com.apple.ScreenTimeAgent": self.disable_screentime_checkbox.isChecked(),
-                "com.apple.tipsd": self.disable_tipsd_checkbox.isChecked(),
-        }
-
-        report_crash_services = [
-            "com.apple.ReportCrash",
-            "com.apple.ReportCrash.DirectoryService",
-            "com.apple.ReportCrash.Jetsam",
-            "com.apple.ReportCrash.SafetyNet",
-            "com.apple.ReportCrash.StackShot",
-            "com.apple.ReportMemoryException",
-            "com.apple.ReportSystemMemory",
-            "com.apple.OTACrashCopier",
-            "com.apple.ProxiedCrashCopier",
-            "com.apple.ProxiedCrashCopier.ProxyingDevice",
-            "com.apple.analyticsd",
-            "com.apple.awdd",
-            "com.apple.wifianalyticsd",
-            "com.apple.aslmanager",
-            "com.apple.coresymbolicationd",
-            "com.apple.crash_mover",
-            "com.apple.crashreportcopymobile",
-            "com.apple.CrashHousekeeping",
-            "com.apple.DumpBasebandCrash",
-            "com.apple.DumpPanic",
-            "com.apple.logd",
-            "com.apple.logd.admin",
-            "com.apple.logd.events",
-            "com.apple.logd.watchdog",
-            "com.apple.logd_helper",
-            "com.apple.logd_reporter",
-            "com.apple.logd_reporter.report_statistics",
-            "com.apple.system.logger",
-            "com.apple.hangreporter",
-            "com.apple.hangtracerd",
-            "com.apple.spindump",
-            "com.apple.tailspind",
-            "com.apple.rtcreportingd",
-            "com.apple.syslogd",
-            "com.apple.syslog_relay",
-            "com.apple.signpost.signpost_reporter",
-            "com.apple.pluginkit.pkreporter"
-        ]
-
-        if self.disable_reportcrash_checkbox.isChecked():
-            for service in report_crash_services:
-                plist[service] = True
-        else:
-            for service in report_crash_services:
-                plist.pop(service, None)
-
-        for key, value in checkbox_settings.items():
-            if value:
-                plist[key] = True
-            else:
-                plist.pop(key, None)
-
-        return plistlib.dumps(plist, fmt=plistlib.FMT_XML)
+        return {tweak for tweak, checkbox in checkboxes.items() if checkbox.isChecked()}
 
     def apply_changes(self):
         if not self.device:
@@ -452,10 +480,11 @@ class App(QtWidgets.QWidget):
 
         self.apply_worker = ApplyWorker(
             device=self.device,
-            files_to_restore_func=self.modify_disabled_plist,
-            skip_setup_func=self.add_skip_setup,
+            tweaks=self.selected_tweaks(),
+            skip_setup=self.skip_setup,
             language_pack=self.language_pack,
-            language=self.language
+            language=self.language,
+            wait_ready=self.wait_ready_checkbox.isChecked()
         )
         self.apply_worker.progress.connect(self.on_apply_progress)
         self.apply_worker.finished.connect(self.on_apply_finished)
@@ -475,33 +504,6 @@ class App(QtWidgets.QWidget):
                                            f"{self.language_pack[self.language]['error']}\n{message}")
             print(traceback.format_exc())
 
-    def add_skip_setup(self, files_to_restore):
-        if self.skip_setup:
-            cloud_config_plist = {
-                "SkipSetup": ["WiFi", "Location", "Restore", "SIMSetup", "Android", "AppleID", "IntendedUser", "TOS", "Siri", "ScreenTime", "Diagnostics", "SoftwareUpdate", "Passcode", "Biometric", "Payment", "Zoom", "DisplayTone", "MessagingActivationUsingPhoneNumber", "HomeButtonSensitivity", "CloudStorage", "ScreenSaver", "TapToSetup", "Keyboard", "PreferredLanguage", "SpokenLanguage", "WatchMigration", "OnBoarding", "TVProviderSignIn", "TVHomeScreenSync", "Privacy", "TVRoom", "iMessageAndFaceTime", "AppStore", "Safety", "Multitasking", "ActionButton", "TermsOfAddress", "AccessibilityAppearance", "Welcome", "Appearance", "RestoreCompleted", "UpdateCompleted"],
-                "AllowPairing": True,
-                "ConfigurationWasApplied": True,
-                "CloudConfigurationUIComplete": True,
-                "ConfigurationSource": 0,
-                "PostSetupProfileWasInstalled": True,
-                "IsSupervised": False,
-            }
-            files_to_restore.append(FileToRestore(
-                contents=plistlib.dumps(cloud_config_plist),
-                restore_path="systemgroup.com.apple.configurationprofiles/Library/ConfigurationProfiles/CloudConfigurationDetails.plist",
-                domain="SysSharedContainerDomain-."
-            ))
-            purplebuddy_plist = {
-                "SetupDone": True,
-                "SetupFinishedAllSteps": True,
-                "UserChoseLanguage": True
-            }
-            files_to_restore.append(FileToRestore(
-                contents=plistlib.dumps(purplebuddy_plist),
-                restore_path="mobile/com.apple.purplebuddy.plist",
-                domain="ManagedPreferencesDomain"
-            ))
-
     def change_language(self, lang_code):
         self.language = lang_code
         self.update_ui_texts()
@@ -532,6 +534,8 @@ class App(QtWidgets.QWidget):
         self.disable_reportcrash_checkbox.setToolTip(menu_notes[5])
         self.disable_tipsd_checkbox.setText(menu_options[6])
         self.disable_tipsd_checkbox.setToolTip(menu_notes[6])
+        self.wait_ready_checkbox.setText(self.language_pack[self.language]["wait_ready"])
+        self.wait_ready_checkbox.setToolTip(self.language_pack[self.language]["wait_ready_note"])
 
         self.apply_button.setText(menu_options[7])
         self.refresh_button.setText(menu_options[8])